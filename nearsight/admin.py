@@ -15,7 +15,7 @@
 from __future__ import absolute_import
 
 from django.contrib import admin
-from .models import S3Credential, S3Bucket, Filter, FilterGeneric, FilterArea
+from .models import S3Credential, S3Bucket, Filter, FilterGeneric, FilterArea, TextFilter
 from django.contrib import messages
 import logging
 
@@ -57,6 +57,20 @@ class FilterAreaInline(FilterGenericInline):
     )
 
 
+class TextFilterInline(FilterGenericInline):
+    model = TextFilter
+    extra = 0
+    fieldsets = (
+        (None, {
+            'fields': ('text_filter_enabled',
+                       'text_filter_name',
+                       'text_filter_keywords',
+                       'text_filter_patterns'),
+            'description': "Data containing any of the keywords or patterns can be excluded or included."
+        }),
+    )
+
+
 class FilterAdmin(admin.ModelAdmin):
     actions = None
     readonly_fields = ('filter_name', 'filter_previous_status')
@@ -103,6 +117,7 @@ class FilterAdmin(admin.ModelAdmin):
                     'title': "Filter Previous Confirmation",
                     'formset': request.POST,
                     'request': request,
+                    'estimate': self.get_filter_estimate(obj),
                 }
                 confirmation_page = get_template('nearsight/confirmation.html')
                 return TemplateResponse(request, confirmation_page, context, current_app=self.admin_site.name)
@@ -119,6 +134,24 @@ class FilterAdmin(admin.ModelAdmin):
                                    current_app=self.admin_site.name)
             return HttpResponseRedirect(post_url)
 
+    @staticmethod
+    def get_filter_estimate(obj):
+        """
+
+        Args:
+            obj: The Filter with the settings submitted for confirmation.
+
+        Returns: The estimate from a dry run of the filter on a sample of the features, or None if it failed.
+        """
+        from .filters.run_filters import estimate_filter_impact
+
+        try:
+            return estimate_filter_impact(obj, after_time_added=obj.filter_previous_time)
+        except Exception as e:
+            logger.error("Unable to estimate the impact of the filter {}.".format(obj.filter_name))
+            logger.error(repr(e))
+            return None
+
     def save_model(self, request, obj, form, change):
         if obj.is_filter_running():
             messages.error(request, "The filter settings cannot be changed while filtering is in progress. \n"
@@ -181,6 +214,8 @@ class FilterAdmin(admin.ModelAdmin):
 
         if obj.filter_name == 'geospatial_filter.py':
             inlines = [FilterAreaInline]
+        elif obj.filter_name == 'text_filter.py':
+            inlines = [TextFilterInline]
         else:
             inlines = []
 
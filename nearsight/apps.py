@@ -33,6 +33,7 @@ class NearSightConfig(AppConfig):
         try:
             from .models import Layer
             from .filters.run_filters import check_filters
+            from .signals import handlers  # Imported to register the signals with django.
             if not current_process().daemon:
                 test_lock, test_read = test_cache()
                 if not test_lock:
@@ -7,6 +7,9 @@ import logging
 
 logger = logging.getLogger(__file__)
 
+# This filter only checks the geometry of a feature, so it can filter features which are only a location.
+LOCATION_FILTER = True
+
 def filter_features(input_features, **kwargs):
     """
     Args:
@@ -45,27 +48,12 @@ def iterate_geojson(input_features, filter_inclusion=None, **kwargs):
     else:
         filter_inclusion = linked_filter.filter_inclusion
     for feature in features:
-        feature_passed = None
         if not feature or not feature.get('geometry'):
             continue
-        coords = feature.get('geometry').get('coordinates')
-        if coords:
-            for filter_shape in filter_list:
-                if check_geometry(coords, filter_shape) and filter_inclusion:
-                    feature_passed = True  # To pass inclusion the feature needs to be in only one shape.
-                    break
-                elif not check_geometry(coords, filter_shape) and not filter_inclusion:
-                    continue  # To pass exclusion the feature needs to not exist in any shape.
-                else:
-                    feature_passed = False
-            if feature_passed is None:
-                feature_passed = True
-            if feature_passed:
-                passed.append(feature)
-            else:
-                failed.append(feature)
-        else:
+        if check_feature(feature, filter_list, filter_inclusion):
             passed.append(feature)
+        else:
+            failed.append(feature)
     passed_features = copy.deepcopy(input_features)
     passed_features['features'] = passed
     failed_features = input_features
@@ -73,6 +61,56 @@ def iterate_geojson(input_features, filter_inclusion=None, **kwargs):
     return {'passed': passed_features, 'failed': failed_features}
 
 
+def get_predicate(filter_model, boundary_features=None, filter_inclusion=None):
+    """
+    Args:
+        filter_model: The Filter model for this filter.
+        boundary_features: Optionally override the FilterArea models with a list of shapely geometries.
+        filter_inclusion: Optionally override the model, for include/exclude for use in testing.
+
+    Returns:
+        A function which takes a geojson feature and returns True if it passes the filter,
+        or None if the filter areas could not be loaded.
+    """
+    linked_filter, filter_list = create_filter_list(boundary_features=boundary_features)
+    if filter_list is None:
+        return None
+    if filter_inclusion is None:
+        filter_inclusion = filter_model.filter_inclusion
+
+    def predicate(feature):
+        if not feature.get('geometry'):
+            return True
+        return check_feature(feature, filter_list, filter_inclusion)
+    return predicate
+
+
+def check_feature(feature, filter_list, filter_inclusion):
+    """
+    Args:
+        feature: A geojson feature with a geometry.
+        filter_list: A list of filter areas, each an array of shapely Polygons/MultiPolygons.
+        filter_inclusion: True if features must lie in an area, False if they must not lie in any area.
+
+    Returns:
+        True if the feature passes the filter.
+    """
+    geometry = feature.get('geometry')
+    coords = geometry.get('coordinates')
+    if not coords or not filter_list:
+        return True
+    if geometry.get('type') != 'Point':
+        # Lines and polygons are checked at the same point as in filter_db_features (ST_PointOnSurface).
+        point = shape(geometry).representative_point()
+        coords = [point.x, point.y]
+    # To pass inclusion the feature needs to be in only one shape.
+    # To pass exclusion the feature needs to not exist in any shape.
+    is_contained = any(check_geometry(coords, filter_shape) for filter_shape in filter_list)
+    if filter_inclusion:
+        return is_contained
+    return not is_contained
+
+
 def create_filter_list(boundary_features=None):
     from ..models import FilterArea
     filter_list = []
@@ -92,6 +130,99 @@ def create_filter_list(boundary_features=None):
         return linked_filter, filter_list
 
 
+def filter_db_features(filter_model, database_alias=None):
+    """Removes the features which fail the filter from every layer table with one query per table,
+    and removes the matching Feature models.
+
+    Args:
+        filter_model: The Filter model for this filter.
+        database_alias: Alias of database in the django DATABASES dict.
+
+    Returns:
+        The number of features removed, or None if the database can not be used to filter the features.
+    """
+    from django.db import connection, connections, transaction, DatabaseError
+    from psycopg2 import Binary
+    from ..models import Feature, Layer
+    from ..nearsight import is_db_supported, is_alnum, chunks
+
+    if not is_db_supported(database_alias):
+        return None
+    linked_filter, filter_list = create_filter_list()
+    if filter_list is None:
+        return None
+    boundaries = [boundary for boundaries in filter_list for boundary in boundaries]
+    if not boundaries:
+        return 0
+
+    if database_alias:
+        db_conn = connections[database_alias]
+    else:
+        db_conn = connection
+
+    if filter_model.filter_inclusion:
+        # To pass inclusion the feature needs to be in only one shape.
+        condition = "NOT EXISTS"
+    else:
+        # To pass exclusion the feature needs to not exist in any shape.
+        condition = "EXISTS"
+    removed_ids = {}
+    with transaction.atomic(using=database_alias):
+        cur = db_conn.cursor()
+        try:
+            cur.execute("CREATE TEMP TABLE nearsight_filter_areas (geom geometry(Geometry, 4326)) ON COMMIT DROP;")
+            for boundary in boundaries:
+                cur.execute("INSERT INTO nearsight_filter_areas (geom) VALUES (ST_GeomFromWKB(%s, 4326));",
+                            [Binary(boundary.wkb)])
+            cur.execute("CREATE INDEX ON nearsight_filter_areas USING GIST (geom);")
+            cur.execute("ANALYZE nearsight_filter_areas;")
+            for layer in Layer.objects.all():
+                table = layer.layer_name
+                if not is_alnum(table):
+                    continue
+                geometry_column = get_geometry_column(cur, table)
+                if not geometry_column:
+                    continue
+                query = "DELETE FROM {table} WHERE {column} IS NOT NULL AND {condition} (" \
+                        "SELECT 1 FROM nearsight_filter_areas " \
+                        "WHERE ST_Contains(nearsight_filter_areas.geom, " \
+                        "ST_PointOnSurface(ST_Transform({table}.{column}, 4326)))) " \
+                        "RETURNING nearsight_id;".format(table=table, column=geometry_column, condition=condition)
+                cur.execute(query)
+                removed_ids[layer] = [row[0] for row in cur.fetchall()]
+                logger.info("Removed {0} features from {1}".format(len(removed_ids[layer]), table))
+        except DatabaseError as de:
+            logger.error("Unable to filter the features in the database.")
+            logger.error(de)
+            raise
+        finally:
+            cur.close()
+
+    # The layer tables may be in a different database, so the Feature models are removed once they are committed.
+    removed_count = 0
+    for layer, layer_removed_ids in removed_ids.iteritems():
+        for removed_chunk in chunks(layer_removed_ids, 1000):
+            Feature.objects.filter(layer=layer, feature_uid__in=removed_chunk).delete()
+        removed_count += len(layer_removed_ids)
+    return removed_count
+
+
+def get_geometry_column(cursor, table):
+    """
+    Args:
+        cursor: A database cursor.
+        table: A layer table.
+
+    Returns:
+        The name of the geometry column of the table, or None if the table does not exist.
+    """
+    cursor.execute("SELECT f_geometry_column FROM geometry_columns WHERE f_table_name = %s;", [table])
+    row = cursor.fetchone()
+    if row:
+        return row[0]
+    return None
+
+
 def check_geometry(coords, boundary_features):
     """
     Args:
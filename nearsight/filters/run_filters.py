@@ -1,83 +1,301 @@
 from __future__ import absolute_import
 
 import os
+import json
+import random
+import threading
+import time
+from hashlib import md5
 from importlib import import_module
+from multiprocessing import Pool, cpu_count
+from uuid import uuid4
+from django.conf import settings
+from django.core.cache import caches
 from django.core.exceptions import ImproperlyConfigured
-from django.db import OperationalError
+from django.db import IntegrityError, OperationalError, transaction
 import logging
 
 logger = logging.getLogger(__file__)
 
-def filter_features(features, filter_name=None, run_once=False):
+FILTER_PACKAGE = 'nearsight.filters'
+FILTER_VERSION_KEY = 'nearsight-filter-registry-version'
+NON_FILTER_MODULES = ['run_filters.py', '__init__.py']
+
+# How many times random ids are drawn to fill a sample, and the most ids drawn at once (see get_feature_sample).
+SAMPLE_ATTEMPTS = 4
+MAX_SAMPLE_CANDIDATES = 20000
+
+# The filter chain used by pool workers, it is set before the pool is forked so each worker inherits it.
+worker_chain = None
+
+
+class RegisteredFilter(object):
+    """A Filter model, its module, and the measured cost of running its predicate."""
+
+    def __init__(self, model, module, cost=0.0):
+        self.name = model.filter_name
+        self.model = model
+        self.module = module
+        self.cost = cost
+        self.predicate = None
+        self.is_process_safe = True
+        self.config_hash = None
+
+    def get_predicate(self):
+        """
+        Returns: A function which takes a geojson feature and returns True if it passes the filter,
+        or None if the filter could not be loaded.
+
+        Modules without a get_predicate function are run through their filter_features function one feature at a time.
+        """
+        if self.predicate is None:
+            if 'get_predicate' in dir(self.module):
+                self.predicate = self.module.get_predicate(self.model)
+            else:
+                # The module may query the database, which a forked process can not share.
+                self.is_process_safe = False
+                module = self.module
+
+                def predicate(feature):
+                    results = module.filter_features({"type": "FeatureCollection", "features": [feature]})
+                    return bool(results and results.get('passed').get('features'))
+                self.predicate = predicate
+        return self.predicate
+
+    def get_config_hash(self):
+        """
+        Returns: The hash of the filter settings, see get_filter_config_hash.
+        """
+        if self.config_hash is None:
+            self.config_hash = get_filter_config_hash(self.model)
+        return self.config_hash
+
+    def record_cost(self, seconds, calls):
+        """Updates the average seconds per feature, weighting the newest measurement most.
+
+        Args:
+            seconds: The time spent in the predicate.
+            calls: The number of features the predicate was called with.
+        """
+        if not calls:
+            return
+        if self.cost:
+            self.cost = (self.cost + (seconds / calls)) / 2
+        else:
+            self.cost = seconds / calls
+
+
+class FilterRegistry(object):
+    """Holds the filter modules and their Filter models for the life of the process.
+
+    The filters package is scanned and imported once.  The Filter rows are only read again when the
+    filter version in the cache changes (see invalidate_filters).
+    """
+
+    def __init__(self):
+        self.modules = None
+        self.filters = []
+        self.version = None
+        self.is_setup = False
+        self.lock = threading.RLock()
+
+    def discover(self):
+        """
+        Returns: A dict of filter file names (e.g. geospatial_filter.py) to the imported filter modules.
+        """
+        with self.lock:
+            if self.modules is None:
+                modules = {}
+                workspace = os.path.dirname(os.path.abspath(__file__))
+                for filter_file in os.listdir(workspace):
+                    if not filter_file.endswith('.py') or filter_file in NON_FILTER_MODULES:
+                        continue
+                    try:
+                        modules[filter_file] = import_module('{0}.{1}'.format(FILTER_PACKAGE,
+                                                                              os.path.splitext(filter_file)[0]))
+                    except ImportError as ie:
+                        logger.error("Could not import the filter {0}.".format(filter_file))
+                        logger.error(ie)
+                self.modules = modules
+            return self.modules
+
+    def has_filter_models(self):
+        """
+        Returns: True if a Filter model exists for every filter module.
+        """
+        from ..models import Filter
+
+        modules = self.discover()
+        return Filter.objects.filter(filter_name__in=modules.keys()).count() == len(modules)
+
+    def setup(self):
+        """
+        Returns: True if every filter module has a Filter model and was set up.
+
+        Creates the Filter model for each filter module and calls its setup_filter_model.
+        This is done once per process, unless the Filter models are removed (e.g. a rolled back transaction).
+        """
+        from ..models import Filter
+
+        with self.lock:
+            if self.is_setup and self.has_filter_models():
+                return True
+            self.is_setup = False
+            for filter_file, mod in self.discover().iteritems():
+                try:
+                    if not Filter.objects.filter(filter_name__iexact=filter_file).exists():
+                        filter_model = Filter.objects.create(filter_name=filter_file)
+                        logger.info("Created filter {}".format(filter_model.filter_name))
+                except IntegrityError:
+                    return False
+                if 'setup_filter_model' in dir(mod):
+                    if mod.setup_filter_model() is False:
+                        return False
+            # The Filter models may have been replaced, so they are read again on the next call.
+            self.version = None
+            self.is_setup = True
+            return True
+
+    def refresh(self, version=None):
+        """Reads the Filter models from the database and pairs them with their modules.
+        The measured cost of each filter is kept.
+
+        Args:
+            version: The filter version the Filter models were read at.
+        """
+        from ..models import Filter
+
+        modules = self.discover()
+        with self.lock:
+            costs = dict((registered_filter.name, registered_filter.cost) for registered_filter in self.filters)
+            filters = []
+            for filter_model in Filter.objects.all():
+                mod = modules.get(filter_model.filter_name)
+                if not mod:
+                    logger.error("The filter {} was found in the database but the module is "
+                                 "missing.".format(filter_model.filter_name))
+                    logger.error("It will be disabled.  If the module is installed later, reenable the filter "
+                                 "in the admin console.")
+                    continue
+                filters.append(RegisteredFilter(filter_model, mod, cost=costs.get(filter_model.filter_name, 0.0)))
+            self.filters = filters
+            self.version = version
+
+    def get_filters(self, filter_name=None):
+        """
+        Args:
+            filter_name: The name of a filter to get, if None all filters are returned (default:None)
+
+        Returns: A list of RegisteredFilter objects.
+        """
+        version = get_filter_version()
+        with self.lock:
+            if version is None or version != self.version:
+                self.refresh(version)
+            filters = list(self.filters)
+        if filter_name:
+            filters = [registered_filter for registered_filter in filters
+                       if registered_filter.name.lower() == filter_name.lower()]
+        return filters
+
+
+registry = FilterRegistry()
+
+
+def get_filter_version():
+    """
+    Returns: A token shared through the cache which changes whenever the filter settings change.
+    """
+    version = caches['nearsight'].get(FILTER_VERSION_KEY)
+    if version is None:
+        caches['nearsight'].add(FILTER_VERSION_KEY, uuid4().hex, None)
+        version = caches['nearsight'].get(FILTER_VERSION_KEY)
+    return version
+
+
+def invalidate_filters():
+    """Changes the filter version so every process reloads its filter settings on the next filter call."""
+    caches['nearsight'].set(FILTER_VERSION_KEY, uuid4().hex, None)
+
+
+def get_filter_config_hash(filter_model):
+    """
+    Args:
+        filter_model: A Filter model.
+
+    Returns: A hash of the settings which decide if a feature passes the filter.
+    """
+    from ..models import FilterArea, TextFilter
+
+    config = [filter_model.filter_name, filter_model.filter_inclusion]
+    for filter_area in FilterArea.objects.filter(filter=filter_model).order_by('pk'):
+        config += [[filter_area.filter_area_enabled,
+                    filter_area.filter_area_buffer,
+                    md5(filter_area.filter_area_data.encode('utf-8')).hexdigest()]]
+    for text_filter in TextFilter.objects.filter(filter=filter_model).order_by('pk'):
+        config += [[text_filter.text_filter_enabled,
+                    text_filter.text_filter_keywords,
+                    text_filter.text_filter_patterns]]
+    return md5(json.dumps(config)).hexdigest()
+
+
+def get_decision_key(feature):
+    """
+    Args:
+        feature: A geojson feature.
+
+    Returns: The nearsight_id and version of the feature as a tuple, the id is None if the feature has none.
+    """
+    properties = feature.get('properties') or {}
+    try:
+        version = int(properties.get('version') or 0)
+    except (TypeError, ValueError):
+        version = 0
+    return properties.get('nearsight_id'), version
+
+
+def filter_features(features, filter_name=None, run_once=False, parallel=None, memoize=False):
     """
 
     Args:
         features: A geojson Feature Collection
         filter_name: The name of a filter to use if None all active filters are used (default:None)
         run_once: Run the filter one time without being active.
+        parallel: True to filter in a process pool, False to filter in this process,
+            None to use a process pool only for more than NEARSIGHT_FILTER_PARALLEL_THRESHOLD features (default:None)
+        memoize: Reuse and save the FilterDecision of each feature version for the current filter settings.
     Returns:
          Geojson Feature Collection that passed any filters in the in filter package
          If no features passed None is returned
     """
 
-    from ..models import Filter
-    from ..nearsight import delete_feature
-
-    workspace = os.path.dirname(os.path.abspath(__file__))
-    files = os.listdir(workspace)
+    from ..nearsight import delete_features
 
     if features.get('features'):
         filtered_feature_count = len(features.get('features'))
-        filtered_results = None
-        if filter_name:
-            filter_models = Filter.objects.filter(filter_name__iexact=filter_name)
-        else:
-            filter_models = Filter.objects.all()
-        if filter_models:
-            un_needed = []
-            for filter_model in filter_models:
-                if filter_model.filter_name in files:
-                    if filter_model.filter_active or run_once:
-                        if not features:
-                            break
-                        try:
-                            module_name = 'nearsight.filters.' + str(filter_model.filter_name.rstrip('.py'))
-                            mod = import_module(module_name)
-                            filtered_results = mod.filter_features(features)
-                        except ImportError:
-                            logging.error("Could not filter features - ImportError")
-                        except TypeError as te:
-                            logging.error(te)
-                            logging.error("Could not filter features - TypeError")
-                        except Exception as e:
-                            logging.error("Unknown error occurred, could not filter features")
-                            logging.error(repr(e))
-                        if filtered_results:
-                            if filtered_results.get('failed').get('features'):
-                                for feature in filtered_results.get('failed').get('features'):
-                                    if run_once:
-                                        delete_feature(feature.get('properties').get('nearsight_id'))
-                                logging.warn("{} features failed the filter".format(
-                                        len(filtered_results.get('failed').get('features'))))
-                            if filtered_results.get('passed').get('features'):
-                                logging.info("{} features passed the filter".format(
-                                        len(filtered_results.get('passed').get('features'))))
-                                features = filtered_results.get('passed')
-                                filtered_feature_count = len(filtered_results.get('passed').get('features'))
-                            else:
-                                features = None
-                                filtered_feature_count = 0
-                        else:
-                            logging.error("Failure to get filtered results")
-                else:
-                    un_needed.append(filter_model)
-            if un_needed:
-                for filter_model in un_needed:
-                    logging.error("The filter {} was found in the database but the module is "
-                          "missing.".format(filter_model.filter_name))
-                    logging.error("It will be disabled.  If the module is installed later, reenable the filter "
-                          "in the admin console.")
-                    filter_model.filter_active = False
+        filters = get_active_filters(filter_name=filter_name, run_once=run_once)
+        if filters:
+            if memoize:
+                filtered_results = run_memoized_filter_chain(features, filters, parallel=parallel)
+            else:
+                filtered_results = run_filter_chain(features, filters, parallel=parallel)
+            failed_features = filtered_results.get('failed').get('features')
+            if failed_features:
+                rejections = {}
+                for feature in failed_features:
+                    rejections[feature.get('rejected_by')] = rejections.get(feature.get('rejected_by'), 0) + 1
+                if run_once:
+                    delete_features([feature.get('properties').get('nearsight_id') for feature in failed_features])
+                for rejected_by, rejected_count in rejections.iteritems():
+                    logging.warn("{0} features failed the filter {1}".format(rejected_count, rejected_by))
+            if filtered_results.get('passed').get('features'):
+                logging.info("{} features passed the filter".format(
+                        len(filtered_results.get('passed').get('features'))))
+                features = filtered_results.get('passed')
+                filtered_feature_count = len(filtered_results.get('passed').get('features'))
+            else:
+                features = None
+                filtered_feature_count = 0
     else:
         features = None
         filtered_feature_count = 0
@@ -85,45 +303,482 @@ def filter_features(features, filter_name=None, run_once=False):
     return features, filtered_feature_count
 
 
+def get_active_filters(filter_name=None, run_once=False):
+    """
+    Args:
+        filter_name: The name of a filter to use if None all active filters are used (default:None)
+        run_once: Use the filter even if it is not active.
+
+    Returns: A list of RegisteredFilter objects.
+    """
+    return [registered_filter for registered_filter in registry.get_filters(filter_name)
+            if registered_filter.model.filter_active or run_once]
+
+
+def get_failed_features(features, filter_name=None, run_once=False, location_only=False):
+    """Filters the features without removing anything from the database.
+
+    Args:
+        features: A geojson Feature Collection
+        filter_name: The name of a filter to use if None all active filters are used (default:None)
+        run_once: Run the filter one time without being active.
+        location_only: Only use the filters which check the location of a feature (see LOCATION_FILTER),
+            for features which don't have their data as properties.
+
+    Returns: A list of the features which failed a filter, each with the filter name as 'rejected_by'.
+    """
+    filters = get_active_filters(filter_name=filter_name, run_once=run_once)
+    if location_only:
+        filters = [registered_filter for registered_filter in filters
+                   if getattr(registered_filter.module, 'LOCATION_FILTER', False)]
+    if not filters or not features.get('features'):
+        return []
+    return run_filter_chain(features, filters).get('failed').get('features')
+
+
+def run_filter_chain(features, filters, parallel=None):
+    """Runs every feature through the filters in one pass, stopping at the first filter which rejects it.
+    The filters are run cheapest first, using the cost measured on previous calls.
+
+    Args:
+        features: A geojson Feature Collection
+        filters: A list of RegisteredFilter objects.
+        parallel: See filter_features.
+
+    Returns:
+        A dict of two geojson feature collections: passed and failed.
+        Each failed feature has the name of the filter which rejected it as 'rejected_by'.
+    """
+    chain = []
+    for registered_filter in sorted(filters, key=lambda (registered_filter): registered_filter.cost):
+        try:
+            predicate = registered_filter.get_predicate()
+        except Exception as e:
+            logging.error("Unknown error occurred, could not load the filter {}".format(registered_filter.name))
+            logging.error(repr(e))
+            continue
+        if predicate is None:
+            logging.error("Failure to load the filter {}".format(registered_filter.name))
+            continue
+        chain.append((registered_filter, predicate))
+
+    feature_list = [feature for feature in features.get('features') if feature]
+    processes = get_filter_process_count(len(feature_list), parallel=parallel)
+    if processes > 1 and not all(registered_filter.is_process_safe for registered_filter, predicate in chain):
+        logger.info("Filtering in a single process because a filter does not provide get_predicate.")
+        processes = 1
+
+    results = None
+    if processes > 1:
+        results = filter_in_pool(chain, feature_list, processes)
+    if results is None:
+        results = [apply_chain(chain, feature_list)]
+
+    passed = []
+    failed = []
+    costs = [[0.0, 0] for link in chain]
+    for shard_passed, shard_failed, shard_costs in results:
+        passed += shard_passed
+        failed += shard_failed
+        for index, (seconds, calls) in enumerate(shard_costs):
+            costs[index][0] += seconds
+            costs[index][1] += calls
+    for (registered_filter, predicate), (seconds, calls) in zip(chain, costs):
+        registered_filter.record_cost(seconds, calls)
+
+    passed_features = dict(features)
+    passed_features['features'] = passed
+    failed_features = dict(features)
+    failed_features['features'] = failed
+    return {'passed': passed_features, 'failed': failed_features}
+
+
+def run_memoized_filter_chain(features, filters, parallel=None):
+    """Like run_filter_chain, but features with a saved FilterDecision for their version and the current filter
+    settings are not filtered again.  The decisions for the filtered features are saved.
+
+    Args:
+        features: A geojson Feature Collection
+        filters: A list of RegisteredFilter objects.
+        parallel: See filter_features.
+
+    Returns:
+        See run_filter_chain.
+    """
+    from ..models import FilterDecision
+
+    config_hashes = dict((registered_filter.name, registered_filter.get_config_hash())
+                         for registered_filter in filters)
+    feature_list = [feature for feature in features.get('features') if feature]
+    feature_uids = set(get_decision_key(feature)[0] for feature in feature_list)
+    feature_uids.discard(None)
+
+    decisions = {}
+    if feature_uids:
+        saved_decisions = FilterDecision.objects.filter(feature_uid__in=feature_uids,
+                                                        filter__in=config_hashes.keys())
+        for feature_uid, feature_version, filter_name, config_hash, filter_passed in saved_decisions.values_list(
+                'feature_uid', 'feature_version', 'filter', 'filter_config_hash', 'filter_passed'):
+            if config_hashes.get(filter_name) == config_hash:
+                decisions[(feature_uid, feature_version, filter_name)] = filter_passed
+
+    passed = []
+    failed = []
+    unknown = []
+    for feature in feature_list:
+        feature_uid, feature_version = get_decision_key(feature)
+        known = [decisions.get((feature_uid, feature_version, registered_filter.name))
+                 for registered_filter in filters]
+        if False in known:
+            feature['rejected_by'] = filters[known.index(False)].name
+            failed.append(feature)
+        elif feature_uid is not None and None not in known:
+            passed.append(feature)
+        else:
+            unknown.append(feature)
+    logger.debug("{0} of {1} features were already filtered".format(len(feature_list) - len(unknown),
+                                                                     len(feature_list)))
+
+    if unknown:
+        unknown_features = dict(features)
+        unknown_features['features'] = unknown
+        filtered_results = run_filter_chain(unknown_features, filters, parallel=parallel)
+        new_decisions = []
+        for feature in filtered_results.get('passed').get('features'):
+            feature_uid, feature_version = get_decision_key(feature)
+            if feature_uid is None:
+                continue
+            for registered_filter in filters:
+                if (feature_uid, feature_version, registered_filter.name) not in decisions:
+                    new_decisions += [FilterDecision(feature_uid=feature_uid,
+                                                     feature_version=feature_version,
+                                                     filter_id=registered_filter.name,
+                                                     filter_config_hash=config_hashes.get(registered_filter.name),
+                                                     filter_passed=True)]
+        for feature in filtered_results.get('failed').get('features'):
+            feature_uid, feature_version = get_decision_key(feature)
+            if feature_uid is None:
+                continue
+            new_decisions += [FilterDecision(feature_uid=feature_uid,
+                                             feature_version=feature_version,
+                                             filter_id=feature.get('rejected_by'),
+                                             filter_config_hash=config_hashes.get(feature.get('rejected_by')),
+                                             filter_passed=False)]
+        save_filter_decisions(new_decisions)
+        passed += filtered_results.get('passed').get('features')
+        failed += filtered_results.get('failed').get('features')
+
+    passed_features = dict(features)
+    passed_features['features'] = passed
+    failed_features = dict(features)
+    failed_features['features'] = failed
+    return {'passed': passed_features, 'failed': failed_features}
+
+
+def save_filter_decisions(decisions):
+    """
+    Args:
+        decisions: A list of unsaved FilterDecision models.
+
+    Returns: True if the decisions were saved.
+    """
+    from ..models import FilterDecision
+
+    if not decisions:
+        return True
+    try:
+        with transaction.atomic():
+            FilterDecision.objects.bulk_create(decisions)
+    except IntegrityError:
+        # Another task saved some of the same decisions, they will be saved on a later run.
+        logger.warn("Unable to save {} filter decisions.".format(len(decisions)))
+        return False
+    return True
+
+
+def prune_filter_decisions(filter_model):
+    """Removes the saved decisions for a filter which were made with different filter settings.
+
+    Args:
+        filter_model: A Filter model.
+    """
+    from ..models import FilterDecision
+
+    FilterDecision.objects.filter(filter=filter_model).exclude(
+        filter_config_hash=get_filter_config_hash(filter_model)).delete()
+
+
+def filter_previous_in_db(filter_name, after_time_added=None):
+    """Lets the filter module remove the features which fail the filter with database queries, if it supports it.
+
+    Args:
+        filter_name: The name of the filter to run.
+        after_time_added: Only features added to the db after this date should be filtered.
+
+    Returns: True if the features were filtered in the database, False if they still need to be filtered.
+    """
+    from django.db import DatabaseError
+    from ..models import default_datetime
+
+    if after_time_added and after_time_added > default_datetime():
+        # The layer tables do not know when a feature was added, so only complete runs can be done in the database.
+        return False
+    if getattr(settings, 'DATABASES', {}).get('nearsight'):
+        database_alias = 'nearsight'
+    else:
+        database_alias = None
+    filters = registry.get_filters(filter_name)
+    if len(filters) != 1 or 'filter_db_features' not in dir(filters[0].module):
+        return False
+    try:
+        removed_count = filters[0].module.filter_db_features(filters[0].model, database_alias=database_alias)
+    except DatabaseError:
+        return False
+    if removed_count is None:
+        return False
+    logging.warn("{0} features failed the filter {1}".format(removed_count, filters[0].name))
+    return True
+
+
+def estimate_filter_impact(filter_model, after_time_added=None, sample_size=None):
+    """Runs the filter on a random sample of the features in each layer without deleting anything,
+    to estimate what filtering the previous features would do.
+
+    The filter areas and text filters are read from the database, so settings which haven't been saved are not used.
+
+    Args:
+        filter_model: A Filter model, it can be unsaved to estimate settings which have not been saved yet.
+        after_time_added: Only estimate features that were added to the db after this date.
+        sample_size: The number of features to sample from each layer (default:NEARSIGHT_FILTER_SAMPLE_SIZE)
+
+    Returns:
+        A dict of the estimated counts and projected filter time for all layers,
+        with the estimate for each layer in 'layers'. None if the filter module is missing.
+    """
+    from ..models import Feature, Layer
+
+    mod = registry.discover().get(filter_model.filter_name)
+    if not mod:
+        return None
+    if not sample_size:
+        sample_size = int(getattr(settings, 'NEARSIGHT_FILTER_SAMPLE_SIZE', 200))
+    registered_filter = RegisteredFilter(filter_model, mod)
+
+    estimate = {'layers': [], 'feature_count': 0, 'sample_count': 0, 'failed_estimate': 0.0,
+                'failed_low': 0.0, 'failed_high': 0.0, 'projected_seconds': 0.0}
+    for layer in Layer.objects.all():
+        features = Feature.objects.filter(layer=layer)
+        if after_time_added:
+            features = features.exclude(feature_added_time__lt=after_time_added)
+        feature_count = features.count()
+        if not feature_count:
+            continue
+        sample = [json.loads(feature_data) for feature_data in
+                  get_feature_sample(features, feature_count, sample_size)]
+        sample_count = len(sample)
+        if not sample_count:
+            continue
+        # Only the filter is timed, it is what runs for every feature when filtering previous features.
+        start_time = time.time()
+        filtered_results = run_filter_chain({"type": "FeatureCollection", "features": sample},
+                                            [registered_filter],
+                                            parallel=False)
+        seconds = time.time() - start_time
+        failed_count = len(filtered_results.get('failed').get('features'))
+        failed_low, failed_high = get_failed_interval(failed_count, sample_count, feature_count)
+        layer_estimate = {'layer_name': layer.layer_name,
+                          'feature_count': feature_count,
+                          'sample_count': sample_count,
+                          'failed_estimate': feature_count * float(failed_count) / sample_count,
+                          'failed_low': feature_count * failed_low,
+                          'failed_high': feature_count * failed_high,
+                          'projected_seconds': seconds / sample_count * feature_count}
+        estimate['layers'] += [layer_estimate]
+        for key in ['feature_count', 'sample_count', 'failed_estimate', 'failed_low', 'failed_high',
+                    'projected_seconds']:
+            estimate[key] += layer_estimate[key]
+        round_estimate(layer_estimate)
+    round_estimate(estimate)
+    return estimate
+
+
+def get_feature_sample(features, feature_count, sample_size):
+    """Picks a uniform random sample of the features by looking up randomly drawn ids,
+    which uses the primary key index instead of sorting the whole table randomly.
+
+    Args:
+        features: A Feature queryset.
+        feature_count: The number of features in the queryset.
+        sample_size: The number of features to sample.
+
+    Returns:
+        A list of the feature_data of the sampled features,
+        which can be short if the ids of the features are spread very thinly.
+    """
+    from django.db.models import Max, Min
+
+    if feature_count <= sample_size:
+        return list(features.values_list('feature_data', flat=True))
+    bounds = features.aggregate(low=Min('pk'), high=Max('pk'))
+    id_range = bounds.get('high') - bounds.get('low') + 1
+    sample = {}
+    for attempt in xrange(SAMPLE_ATTEMPTS):
+        needed = sample_size - len(sample)
+        if needed <= 0:
+            break
+        # Draw enough ids that about half again as many features as needed are found.
+        candidate_count = min(id_range, MAX_SAMPLE_CANDIDATES, int(1.5 * needed * id_range / feature_count) + 1)
+        candidates = random.sample(xrange(bounds.get('low'), bounds.get('high') + 1), candidate_count)
+        found = [(pk, feature_data) for pk, feature_data in
+                 features.filter(pk__in=candidates).values_list('pk', 'feature_data') if pk not in sample]
+        sample.update(random.sample(found, min(needed, len(found))))
+    return sample.values()
+
+
+def get_failed_interval(failed_count, sample_count, feature_count, z=1.96):
+    """A Wilson score interval for the fraction of features which fail the filter,
+    with the sample size corrected for sampling without replacement from the layer.
+    Unlike the normal approximation it doesn't collapse to a single value when no sampled feature fails.
+
+    Args:
+        failed_count: The number of sampled features which failed the filter.
+        sample_count: The number of features sampled.
+        feature_count: The number of features in the layer.
+        z: The normal quantile of the confidence level (default: 1.96 for 95%).
+
+    Returns:
+        A tuple of the low and high failed fraction.
+    """
+    failed_fraction = float(failed_count) / sample_count
+    if sample_count >= feature_count:
+        # Every feature was filtered, so the fraction is exact.
+        return failed_fraction, failed_fraction
+    correction = float(feature_count - sample_count) / (feature_count - 1)
+    effective_count = sample_count / correction
+    denominator = 1 + z ** 2 / effective_count
+    center = (failed_fraction + z ** 2 / (2 * effective_count)) / denominator
+    margin = z * ((failed_fraction * (1 - failed_fraction) / effective_count +
+                   z ** 2 / (4 * effective_count ** 2)) ** 0.5) / denominator
+    return max(0.0, center - margin), min(1.0, center + margin)
+
+
+def round_estimate(estimate):
+    """Rounds the estimate to whole features and seconds, and adds the passed estimate.
+
+    Args:
+        estimate: A dict with a feature_count, failed_estimate, failed_low, failed_high and projected_seconds.
+    """
+    estimate['failed_estimate'] = int(round(estimate['failed_estimate']))
+    estimate['failed_low'] = int(round(estimate['failed_low']))
+    estimate['failed_high'] = int(round(estimate['failed_high']))
+    estimate['passed_estimate'] = estimate['feature_count'] - estimate['failed_estimate']
+    estimate['projected_seconds'] = int(round(estimate['projected_seconds']))
+
+
+def apply_chain(chain, feature_list):
+    """
+    Args:
+        chain: A list of (RegisteredFilter, predicate) tuples in the order they should run.
+        feature_list: A list of geojson features.
+
+    Returns:
+        A tuple of the passed features, the failed features,
+        and a list of (seconds, calls) spent in each predicate of the chain.
+    """
+    passed = []
+    failed = []
+    costs = [[0.0, 0] for link in chain]
+    for feature in feature_list:
+        for index, (registered_filter, predicate) in enumerate(chain):
+            start_time = time.time()
+            try:
+                feature_passed = predicate(feature)
+            except Exception as e:
+                logging.error("Unknown error occurred, could not filter features with {}".format(registered_filter.name))
+                logging.error(repr(e))
+                feature_passed = True
+            costs[index][0] += time.time() - start_time
+            costs[index][1] += 1
+            if not feature_passed:
+                feature['rejected_by'] = registered_filter.name
+                failed.append(feature)
+                break
+        else:
+            passed.append(feature)
+    return passed, failed, costs
+
+
+def get_filter_process_count(feature_count, parallel=None):
+    """
+    Args:
+        feature_count: The number of features to filter.
+        parallel: See filter_features.
+
+    Returns: The number of processes to filter the features with.
+    """
+    if parallel is False:
+        return 1
+    if parallel is None and feature_count < int(getattr(settings, 'NEARSIGHT_FILTER_PARALLEL_THRESHOLD', 10000)):
+        return 1
+    processes = int(getattr(settings, 'NEARSIGHT_FILTER_PROCESSES', None) or cpu_count())
+    return max(1, min(processes, feature_count))
+
+
+def filter_in_pool(chain, feature_list, processes):
+    """Splits the features into shards which are filtered by a pool of forked processes.
+
+    Args:
+        chain: A list of (RegisteredFilter, predicate) tuples in the order they should run.
+        feature_list: A list of geojson features.
+        processes: The number of processes in the pool.
+
+    Returns:
+        A list of apply_chain results for each shard in the order of feature_list,
+        or None if the pool could not be used.
+    """
+    global worker_chain
+
+    shard_size = max(1, len(feature_list) // (processes * 4) + 1)
+    shards = [feature_list[index:index + shard_size] for index in xrange(0, len(feature_list), shard_size)]
+    worker_chain = chain
+    pool = None
+    try:
+        pool = Pool(processes=processes)
+        return pool.map(filter_shard, shards)
+    except (AssertionError, OSError) as e:
+        # Daemonic processes (e.g. some task workers) are not allowed to start a pool.
+        logger.warn("Unable to filter in a process pool, filtering in a single process.")
+        logger.warn(repr(e))
+        return None
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        worker_chain = None
+
+
+def filter_shard(shard):
+    """
+    Args:
+        shard: A list of geojson features.
+
+    Returns: See apply_chain.
+    """
+    return apply_chain(worker_chain, shard)
+
+
 def check_filters():
     """
     Returns: True if checking the filters was successful.
 
     Finds '.py' files used for filtering and adds to db model for use in admin console.
-    Sets cache value so function will not running fully every time it is called by tasks.py
-    """
-    from ..models import Filter
-    from ..tasks import get_lock, set_lock, get_lock_id
-    from django.db import IntegrityError
-    from importlib import import_module
-    workspace = os.path.dirname(os.path.abspath(__file__))
-    files = os.listdir(workspace)
-    if files:
-        lock_id = get_lock_id('list-filters-success')
-        if get_lock(lock_id):
-            return True
-        if not check_init():
-            return False
-        for filter_file in files:
-            if filter_file.endswith('.py'):
-                if filter_file == 'run_filters.py' or filter_file == '__init__.py':
-                    continue
-                try:
-                    filter_names = Filter.objects.filter(filter_name__iexact=filter_file)
-                    if not filter_names.exists():
-                        filter_model = Filter.objects.create(filter_name=filter_file)
-                        logging.info("Created filter {}".format(filter_model.filter_name))
-                except IntegrityError:
-                    return False
-                try:
-                    mod = import_module('nearsight.filters.' + str(filter_file.rstrip('.py')))
-                    if 'setup_filter_model' in dir(mod):
-                        if mod.setup_filter_model() is False:
-                            return False
-                except ImportError:
-                    return False
-        set_lock(lock_id, True, 20)
-    return True
+    The filter registry only does this once per process, later calls only check the Filter models still exist.
+    """
+    if registry.is_setup and registry.has_filter_models():
+        return True
+    if not check_init():
+        return False
+    return registry.setup()
 
 
 def check_init():
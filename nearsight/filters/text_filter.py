@@ -0,0 +1,272 @@
+from types import DictType
+from collections import deque
+from numbers import Number
+import copy
+import re
+import logging
+
+logger = logging.getLogger(__file__)
+
+
+def filter_features(input_features, **kwargs):
+    """
+    Args:
+         input_features: A Geojson feature collection
+
+    Returns:
+        A json of two geojson feature collections: passed and failed
+    """
+    if type(input_features) is DictType:
+        if input_features.get("features"):
+            return iterate_geojson(input_features, **kwargs)
+    else:
+        logger.error("The input_features are in a format {}, "
+                     "which is not compatible with filter_features. Should be dict.".format(type(input_features)))
+        return None
+
+
+def iterate_geojson(input_features, text_matcher=None, filter_inclusion=None):
+    """
+    Args:
+         input_features: A Geojson feature collection
+         text_matcher: Optionally override the TextFilter models with a TextMatcher.
+         filter_inclusion: Optionally choose whether filter should override database settings for inclusion.
+
+    Returns:
+        A json of two geojson feature collections: passed and failed
+    """
+    from ..models import Filter
+    from django.core.exceptions import ObjectDoesNotExist
+
+    try:
+        filter_model = Filter.objects.get(filter_name__iexact='text_filter.py')
+    except ObjectDoesNotExist:
+        logger.error("The text filter was not imported.")
+        return
+    predicate = get_predicate(filter_model, text_matcher=text_matcher, filter_inclusion=filter_inclusion)
+    passed = []
+    failed = []
+    for feature in input_features.get("features"):
+        if not feature:
+            continue
+        if predicate(feature):
+            passed.append(feature)
+        else:
+            failed.append(feature)
+    passed_features = copy.deepcopy(input_features)
+    passed_features['features'] = passed
+    failed_features = input_features
+    failed_features['features'] = failed
+    return {'passed': passed_features, 'failed': failed_features}
+
+
+def get_predicate(filter_model, text_matcher=None, filter_inclusion=None):
+    """
+    Args:
+         filter_model: The Filter model for this filter.
+         text_matcher: Optionally override the TextFilter models with a TextMatcher.
+         filter_inclusion: Optionally choose whether filter should override database settings for inclusion.
+
+    Returns:
+        A function which takes a geojson feature and returns True if it passes the filter.
+    """
+    if text_matcher is None:
+        text_matcher = get_text_matcher(filter_model)
+    if filter_inclusion is None:
+        filter_inclusion = filter_model.filter_inclusion
+
+    def predicate(feature):
+        return check_feature(feature, text_matcher, filter_inclusion)
+    return predicate
+
+
+def check_feature(feature, text_matcher, filter_inclusion):
+    """
+    Args:
+         feature: A geojson feature.
+         text_matcher: A TextMatcher.
+         filter_inclusion: True if features must contain a match, False if they must not.
+
+    Returns:
+        True if the feature passes the filter, features always pass if there is nothing to match.
+    """
+    if text_matcher.is_empty():
+        return True
+    return text_matcher.search(get_feature_text(feature.get('properties'))) == bool(filter_inclusion)
+
+
+def get_feature_text(properties):
+    """
+    Args:
+         properties: The properties of a geojson feature.
+
+    Returns:
+        The string and number values of the properties joined by new lines, so they can be scanned in one pass.
+    """
+    values = []
+    pending = [properties]
+    while pending:
+        value = pending.pop()
+        if isinstance(value, basestring):
+            values.append(value)
+        elif isinstance(value, dict):
+            pending.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            pending.extend(value)
+        elif isinstance(value, Number) and not isinstance(value, bool):
+            values.append(unicode(value))
+    return u'\n'.join(values)
+
+
+def get_text_matcher(filter_model):
+    """
+    Args:
+         filter_model: The Filter model for this filter.
+
+    Returns:
+        A TextMatcher for the keywords and patterns of the enabled TextFilter models.
+    """
+    from ..models import TextFilter
+
+    keywords = []
+    patterns = []
+    for text_filter in TextFilter.objects.filter(filter=filter_model, text_filter_enabled=True).order_by('pk'):
+        keywords += split_lines(text_filter.text_filter_keywords)
+        patterns += split_lines(text_filter.text_filter_patterns)
+    return TextMatcher(keywords=keywords, patterns=patterns)
+
+
+def split_lines(value):
+    """
+    Args:
+         value: Text with one entry per line.
+
+    Returns:
+        A list of the lines which are not blank.
+    """
+    return [line.strip() for line in (value or '').splitlines() if line.strip()]
+
+
+class TextMatcher(object):
+    """Finds any of the keywords (ignoring case) or any of the regular expressions in a string.
+
+    The keywords are compiled into one Aho-Corasick automaton, and the plain patterns into one alternation,
+    so a string is scanned once by each no matter how many keywords and patterns are configured.
+    """
+
+    def __init__(self, keywords=None, patterns=None):
+        self.keywords = KeywordAutomaton(keywords or [])
+        self.patterns = compile_patterns(patterns or [])
+
+    def is_empty(self):
+        return self.keywords.is_empty() and not self.patterns
+
+    def search(self, text):
+        """
+        Args:
+             text: A string.
+
+        Returns:
+            True if a keyword or a pattern is found in the string.
+        """
+        if self.keywords.search(text):
+            return True
+        return any(pattern.search(text) for pattern in self.patterns)
+
+
+def compile_patterns(patterns):
+    """
+    Args:
+         patterns: A list of regular expressions.
+
+    Returns:
+        A list of compiled regular expressions, which is empty if none of the patterns are valid.
+        The plain patterns are joined into a single alternation, patterns with groups (which backreferences
+        would number differently in the alternation) or inline flags (which would apply to every pattern)
+        are compiled on their own.
+    """
+    plain_flags = re.compile(u'', re.UNICODE).flags
+    plain_patterns = []
+    compiled_patterns = []
+    for pattern in patterns:
+        try:
+            compiled_pattern = re.compile(pattern, re.UNICODE)
+        except re.error as e:
+            logger.error("The text filter pattern {0} is not a valid regular expression.".format(pattern))
+            logger.error(e)
+            continue
+        if compiled_pattern.groups or compiled_pattern.flags != plain_flags:
+            compiled_patterns.append(compiled_pattern)
+        else:
+            plain_patterns.append(u'(?:{0})'.format(pattern))
+    if plain_patterns:
+        compiled_patterns.insert(0, re.compile(u'|'.join(plain_patterns), re.UNICODE))
+    return compiled_patterns
+
+
+class KeywordAutomaton(object):
+    """An Aho-Corasick automaton which finds any of a list of keywords in a single pass over a string."""
+
+    def __init__(self, keywords):
+        # Each state has a dict of transitions, a failure state, and whether a keyword ends at the state.
+        self.transitions = [{}]
+        self.failures = [0]
+        self.matches = [False]
+        for keyword in keywords:
+            self.add_keyword(keyword.lower())
+        self.build_failures()
+        # Checked before every search, so it is worked out once rather than scanning every state each time.
+        self.empty = not any(self.matches)
+
+    def is_empty(self):
+        return self.empty
+
+    def add_keyword(self, keyword):
+        if not keyword:
+            return
+        state = 0
+        for character in keyword:
+            next_state = self.transitions[state].get(character)
+            if next_state is None:
+                next_state = len(self.transitions)
+                self.transitions.append({})
+                self.failures.append(0)
+                self.matches.append(False)
+                self.transitions[state][character] = next_state
+            state = next_state
+        self.matches[state] = True
+
+    def build_failures(self):
+        queue = deque(self.transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for character, next_state in self.transitions[state].iteritems():
+                queue.append(next_state)
+                failure = self.failures[state]
+                while failure and character not in self.transitions[failure]:
+                    failure = self.failures[failure]
+                self.failures[next_state] = self.transitions[failure].get(character, 0)
+                # A state matches if any keyword ending at its failure state matches.
+                self.matches[next_state] = self.matches[next_state] or self.matches[self.failures[next_state]]
+
+    def search(self, text):
+        """
+        Args:
+             text: A string.
+
+        Returns:
+            True if any keyword is found in the string, ignoring case.
+        """
+        if self.empty:
+            return False
+        state = 0
+        transitions = self.transitions
+        failures = self.failures
+        matches = self.matches
+        for character in text.lower():
+            while state and character not in transitions[state]:
+                state = failures[state]
+            state = transitions[state].get(character, 0)
+            if matches[state]:
+                return True
+        return False
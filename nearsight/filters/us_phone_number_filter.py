@@ -7,6 +7,10 @@ import logging
 
 logger = logging.getLogger(__file__)
 
+phone_number_pattern = re.compile(
+    '([^0-9]+[(]?[2-9]\d{2}[)]?|^[(]?[2-9]\d{2}[)]?)[^a-zA-Z0-9][2-9]\d{2}(\s|-|[.])(\d{4}[^0-9]+|\d{4}$)')
+area_code_pattern = re.compile('[2-9]\d{2}')
+
 def filter_features(input_features, **kwargs):
     """
     Args:
@@ -53,8 +57,7 @@ def iterate_geojson(input_features, filter_inclusion=None):
     for feature in input_features.get("features"):
         if not feature:
             continue
-        if ((check_numbers(json.dumps(feature.get('properties'))) and filter_inclusion) or
-                (not check_numbers(json.dumps(feature.get('properties'))) and not filter_inclusion)):
+        if check_feature(feature, filter_inclusion):
             passed.append(feature)
         else:
             failed.append(feature)
@@ -67,6 +70,35 @@ def iterate_geojson(input_features, filter_inclusion=None):
     return {'passed': passed_features, 'failed': failed_features}
 
 
+def get_predicate(filter_model, filter_inclusion=None):
+    """
+    Args:
+         filter_model: The Filter model for this filter.
+         filter_inclusion: Optionally choose whether filter should override database settings for inclusion.
+
+    Returns:
+        A function which takes a geojson feature and returns True if it passes the filter.
+    """
+    if filter_inclusion is None:
+        filter_inclusion = filter_model.filter_inclusion
+
+    def predicate(feature):
+        return check_feature(feature, filter_inclusion)
+    return predicate
+
+
+def check_feature(feature, filter_inclusion):
+    """
+    Args:
+         feature: A geojson feature.
+         filter_inclusion: True if features must contain a US phone number, False if they must not.
+
+    Returns:
+        True if the feature passes the filter.
+    """
+    return check_numbers(json.dumps(feature.get('properties'))) == bool(filter_inclusion)
+
+
 def check_numbers(attributes):
     """
     Args:
@@ -76,14 +108,10 @@ def check_numbers(attributes):
         True if a US phone number is found in the string
         False if there is no US phone number found in the string
     """
-    pattern = re.compile(
-        '([^0-9]+[(]?[2-9]\d{2}[)]?|^[(]?[2-9]\d{2}[)]?)[^a-zA-Z0-9][2-9]\d{2}(\s|-|[.])(\d{4}[^0-9]+|\d{4}$)')
-    phone_number = pattern.search(attributes)
+    phone_number = phone_number_pattern.search(attributes)
     if phone_number:
-        area_code_pattern = re.compile('[2-9]\d{2}')
         area_code = int(area_code_pattern.search(phone_number.group()).group())
-        area_codes = get_area_codes()
-        if area_code in area_codes:
+        if area_code in area_code_set:
             return True
         else:
             return False
@@ -171,3 +199,6 @@ def get_area_codes():
         307  # Wyoming
     ]
     return area_codes
+
+
+area_code_set = frozenset(get_area_codes())
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nearsight', '0004_auto_20170718_1327'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FilterDecision',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('feature_uid', models.CharField(max_length=100)),
+                ('feature_version', models.IntegerField(default=0)),
+                ('filter_config_hash', models.CharField(max_length=32)),
+                ('filter_passed', models.BooleanField(default=True)),
+                ('filter', models.ForeignKey(to='nearsight.Filter')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='filterdecision',
+            unique_together=set([('feature_uid', 'feature_version', 'filter', 'filter_config_hash')]),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nearsight', '0005_filterdecision'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='asset',
+            name='asset_latitude',
+            field=models.FloatField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='asset',
+            name='asset_longitude',
+            field=models.FloatField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='asset',
+            name='asset_location_read',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterIndexTogether(
+            name='asset',
+            index_together=set([('asset_latitude', 'asset_longitude')]),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nearsight', '0006_asset_location'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='textfilter',
+            name='text_filter_enabled',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddField(
+            model_name='textfilter',
+            name='text_filter_name',
+            field=models.CharField(default='', max_length=100, blank=True),
+        ),
+        migrations.AddField(
+            model_name='textfilter',
+            name='text_filter_keywords',
+            field=models.TextField(default='', help_text='Words or phrases to find in the data, one per line. Case is ignored.', blank=True),
+        ),
+        migrations.AddField(
+            model_name='textfilter',
+            name='text_filter_patterns',
+            field=models.TextField(default='', help_text='Regular expressions to find in the data, one per line.', blank=True),
+        ),
+    ]
@@ -106,6 +106,33 @@ def get_all_features(after_time_added=None):
     return {"features": features}
 
 
+def get_feature_batches(after_time_added=None, batch_size=1000):
+    """
+    Reads the features in pages ordered by primary key (keyset pagination), so that the table is never loaded at once
+    and features deleted between pages do not shift the following pages.
+
+    Args:
+        after_time_added: get all features that were added to the db after this date.
+        batch_size: The number of features to read at a time.
+
+    Returns:
+        A generator of lists of features as dicts.
+    """
+    features = Feature.objects.all()
+    if after_time_added:
+        features = features.exclude(feature_added_time__lt=after_time_added)
+    last_pk = None
+    while True:
+        page = features
+        if last_pk is not None:
+            page = page.filter(pk__gt=last_pk)
+        rows = list(page.order_by('pk').values_list('pk', 'feature_data')[:batch_size])
+        if not rows:
+            return
+        last_pk = rows[-1][0]
+        yield [json.loads(feature_data) for pk, feature_data in rows]
+
+
 class CustomStorage(FileSystemStorage):
     def get_available_name(self, name):
         return name
@@ -123,6 +150,12 @@ class Asset(models.Model):
     asset_data = models.FileField(storage=CustomStorage(location=get_media_dir(), base_url=get_base_url()),
                                   upload_to=get_asset_name)
     asset_added_time = models.DateTimeField(default=default_datetime())
+    asset_latitude = models.FloatField(null=True, blank=True)
+    asset_longitude = models.FloatField(null=True, blank=True)
+    asset_location_read = models.BooleanField(default=False)
+
+    class Meta:
+        index_together = (("asset_latitude", "asset_longitude"),)
 
     def delete(self, *args, **kwargs):
         super(Asset, self).delete(*args, **kwargs)
@@ -236,8 +269,7 @@ class Filter(models.Model):
             from .tasks import task_filter_features, task_filter_assets
             if getattr(settings, 'NEARSIGHT_USE_CELERY', True):
                 task_filter_features.apply_async(kwargs={'filter_name': self.filter_name,
-                                                         'features': get_all_features(
-                                                             after_time_added=self.filter_previous_time),
+                                                         'after_time_added': self.filter_previous_time.isoformat(),
                                                          'run_once': True,
                                                          'run_time': run_time})
                 task_filter_assets.apply_async(kwargs={'filter_name': self.filter_name,
@@ -246,7 +278,7 @@ class Filter(models.Model):
                                                        'run_time': run_time})
             else:
                 task_filter_features(filter_name=self.filter_name,
-                                     features=self.filter_previous_time,
+                                     after_time_added=self.filter_previous_time.isoformat(),
                                      run_once=True,
                                      run_time=run_time)
                 task_filter_assets(filter_name=self.filter_name,
@@ -258,7 +290,9 @@ class Filter(models.Model):
             self.filter_previous_status = "Filtering is in progress..."
         else:
             self.filter_previous_status = "Filter previous last ran at {}.".format(self.filter_previous_time)
-        super(Filter, self).save(*args, **kwargs)
+        # The row was saved above, so only the fields changed since are written (another insert would fail).
+        super(Filter, self).save(using=kwargs.get('using'),
+                                 update_fields=["filter_previous", "filter_previous_status"])
 
     def is_filter_running(self):
         """
@@ -281,12 +315,48 @@ class Filter(models.Model):
         return self.filter_name + status
 
 
+class FilterDecision(models.Model):
+    """Structure to remember if a feature version passed a filter, for a hash of the filter settings."""
+    feature_uid = models.CharField(max_length=100)
+    feature_version = models.IntegerField(default=0)
+    filter = models.ForeignKey(Filter, on_delete=models.CASCADE)
+    filter_config_hash = models.CharField(max_length=32)
+    filter_passed = models.BooleanField(default=True)
+
+    class Meta:
+        unique_together = (("feature_uid", "feature_version", "filter", "filter_config_hash"),)
+
+
 class FilterGeneric(models.Model):
     filter = models.ForeignKey(Filter)
 
 
 class TextFilter(FilterGeneric):
-    pass
+    text_filter_enabled = models.BooleanField(default=True)
+    text_filter_name = models.CharField(max_length=100, blank=True, default="")
+    text_filter_keywords = models.TextField(blank=True, default="",
+                                            help_text="Words or phrases to find in the data, one per line. "
+                                                      "Case is ignored.")
+    text_filter_patterns = models.TextField(blank=True, default="",
+                                            help_text="Regular expressions to find in the data, one per line.")
+
+    __text_filter_keywords = None
+    __text_filter_patterns = None
+
+    def __init__(self, *args, **kwargs):
+        super(TextFilter, self).__init__(*args, **kwargs)
+        self.__text_filter_keywords = self.text_filter_keywords
+        self.__text_filter_patterns = self.text_filter_patterns
+
+    def save(self, force_insert=False, force_update=False, *args, **kwargs):
+        if (self.text_filter_keywords != self.__text_filter_keywords or
+                self.text_filter_patterns != self.__text_filter_patterns or
+                not self.pk):
+            self.filter.filter_previous_time = default_datetime()
+            self.filter.save()
+        super(TextFilter, self).save(force_insert, force_update, *args, **kwargs)
+        self.__text_filter_keywords = self.text_filter_keywords
+        self.__text_filter_patterns = self.text_filter_patterns
 
 
 class FilterArea(FilterGeneric):
@@ -21,7 +21,8 @@ from .models import Layer, get_data_dir
 import time
 from geoserver.catalog import Catalog, FailedRequestError
 from geoserver.layer import Layer as GeoserverLayer
-from django.db import connection, connections, ProgrammingError, OperationalError, transaction
+from django.db import connection, connections, ProgrammingError, OperationalError, DatabaseError, transaction
+from django.db import DEFAULT_DB_ALIAS
 from django.db.utils import ConnectionDoesNotExist, IntegrityError
 import re
 import shutil
@@ -29,15 +30,35 @@ from django.core.files import File
 import os
 from .models import Asset, get_type_extension, Feature
 from .filters import run_filters
-from PIL import Image
 from PIL.ExifTags import TAGS, GPSTAGS
+from shapely.geometry import shape
+from shapely import wkb
+from cStringIO import StringIO
 import logging
 import subprocess
 import uuid
+import struct
+import tempfile
+import pytz
+import threading
+import zlib
+from multiprocessing import Pool, cpu_count, current_process
+from multiprocessing.pool import ThreadPool
 from httplib import ResponseNotReady
+from contextlib import contextmanager
 
 logger = logging.getLogger(__name__)
 nearsight_status = {"status": ""}
+# The (database alias, table) pairs known to exist and when they were seen in the catalog,
+# they are checked again after EXISTING_TABLE_SECONDS in case the table was dropped by something else.
+existing_tables = {}
+EXISTING_TABLE_SECONDS = 60
+# The (database alias, table) pairs which have had their indexes added by this process.
+indexed_tables = set()
+# The table GeoServer reads primary keys from, for layer tables without a primary key constraint.
+PK_METADATA_TABLE = 'gt_pk_metadata'
+# The staging table and database alias used by load pool workers, it is set before the pool is forked.
+worker_load = None
 
 class NearSight:
 
@@ -145,6 +166,170 @@ def chunks(a_list, chunk_size):
         yield a_list[i:i + chunk_size]
 
 
+class LayerSession(object):
+    """Holds the database connection, and what is known about the layer tables, for a layer load.
+
+    While a session is open (used as a context manager) every raw SQL helper called in the same thread
+    shares it through get_layer_session, so the connection stays open for the whole load,
+    the engine is checked once, and each table's columns are read once.
+    """
+    local = threading.local()
+
+    def __init__(self, database_alias=None):
+        self.database_alias = database_alias or None
+        if self.database_alias:
+            self.db_conn = connections[self.database_alias]
+        else:
+            self.db_conn = connection
+        self.supported = None
+        self.table_columns = {}
+        self.table_partitioning = {}
+
+    def __enter__(self):
+        if not hasattr(LayerSession.local, 'sessions'):
+            LayerSession.local.sessions = []
+        LayerSession.local.sessions.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        LayerSession.local.sessions.remove(self)
+
+    def cursor(self):
+        return self.db_conn.cursor()
+
+    def is_supported(self):
+        """
+        Returns:
+            True if the database is postgres (with or without postgis).
+        """
+        if self.supported is None:
+            engine = self.db_conn.settings_dict.get('ENGINE')
+            self.supported = 'postgis' in engine or 'postgres' in engine
+        return self.supported
+
+    def get_columns(self, table):
+        """
+        Args:
+            table: A DB table.
+
+        Returns:
+            A dict of the column names and their postgres types, which is empty if the table doesn't exist.
+        """
+        if table not in self.table_columns:
+            cur = self.cursor()
+            try:
+                columns = get_table_columns(cur, table)
+            finally:
+                cur.close()
+            if not columns:
+                return columns
+            self.table_columns[table] = columns
+        return self.table_columns.get(table)
+
+    def get_partitioning(self, table):
+        """
+        Args:
+            table: A DB table.
+
+        Returns:
+            'hash' or 'range' if the table is partitioned, otherwise None.
+        """
+        if table not in self.table_partitioning:
+            partitioning = None
+            cur = self.cursor()
+            try:
+                with transaction.atomic(using=self.database_alias):
+                    cur.execute("SELECT partstrat FROM pg_partitioned_table WHERE partrelid = to_regclass(%s);",
+                                [table])
+                    row = cur.fetchone()
+                partitioning = {'h': 'hash', 'r': 'range'}.get(row[0]) if row else None
+            except DatabaseError:
+                # Servers before PostgreSQL 10 don't have partitioned tables.
+                pass
+            finally:
+                cur.close()
+            self.table_partitioning[table] = partitioning
+        return self.table_partitioning.get(table)
+
+    def forget_table(self, table):
+        """Removes what is known about a table, after it is created or altered."""
+        self.table_columns.pop(table, None)
+        self.table_partitioning.pop(table, None)
+
+
+def get_layer_session(database_alias=None):
+    """
+    Args:
+        database_alias: Database dict from the django settings.
+
+    Returns:
+        The innermost open LayerSession in this thread for the database, or a new LayerSession.
+    """
+    for session in reversed(getattr(LayerSession.local, 'sessions', [])):
+        if session.database_alias == (database_alias or None):
+            return session
+    return LayerSession(database_alias)
+
+
+@contextmanager
+def layer_transaction(database_alias=None, table=None):
+    """Runs a layer load in one transaction per database, if NEARSIGHT_LAYER_TRANSACTION is set.
+
+    The Feature and Asset rows, and the changes to the layer table, are committed together when the block exits.
+    The atomic blocks used for each row become savepoints, so a row which fails is rolled back on its own.
+    ogr2ogr uses its own connection, so a table it creates is committed straight away,
+    and it isn't used to append features while the transaction is open.
+    If the transaction is rolled back a table created by the load is dropped, so the next load creates it again.
+
+    Args:
+        database_alias: Database dict from the django settings, for the layer table.
+        table: The layer table, which is forgotten by this process (or dropped if it was created by the load)
+            if the transaction is rolled back.
+
+    Yields:
+        True if the load is in a transaction.
+    """
+    if not getattr(settings, 'NEARSIGHT_LAYER_TRANSACTION', False):
+        yield False
+        return
+
+    is_new_table = bool(table) and not table_exists(database_alias=database_alias, table=table)
+    rolled_back = True
+    try:
+        with transaction.atomic():
+            if (database_alias or DEFAULT_DB_ALIAS) != DEFAULT_DB_ALIAS:
+                with transaction.atomic(using=database_alias):
+                    yield True
+                    needs_rollback = transaction.get_rollback(using=database_alias)
+            else:
+                yield True
+                needs_rollback = False
+            needs_rollback = needs_rollback or transaction.get_rollback()
+        rolled_back = needs_rollback
+    finally:
+        if rolled_back and table:
+            # Indexes and partitions added in the transaction were rolled back with it.
+            indexed_tables.discard((database_alias or None, table.lower()))
+            forget_table_exists(database_alias=database_alias, table=table)
+            if is_new_table:
+                # ogr2ogr committed the table outside of the transaction, with the first feature and no key.
+                drop_layer_table(database_alias=database_alias, table=table)
+
+
+def rollback_layer_transaction(database_alias=None):
+    """Marks the open layer transaction (see layer_transaction) to be rolled back when it exits.
+
+    Args:
+        database_alias: Database dict from the django settings, for the layer table.
+
+    Returns:
+        None
+    """
+    transaction.set_rollback(True)
+    if (database_alias or DEFAULT_DB_ALIAS) != DEFAULT_DB_ALIAS:
+        transaction.set_rollback(True, using=database_alias)
+
+
 def convert_to_epoch_time(date):
     """
 
@@ -343,60 +528,6 @@ def upload_geojson(zip_path=None, file_path=None, geojson=None, request=None):
     nearsight_id = get_nearsight_id_fieldname()
     global nearsight_status
     nearsight_status["progress"] = { "total": total, "completed": 0 }
-    for feature in features:
-        if not feature:
-            continue
-        if not feature.get('geometry'):
-            continue
-        for key in field_map:
-            if key not in feature.get('properties'):
-                feature['properties'][key] = prototype.get(key)
-                if isinstance(feature['properties'][key], type(None)):
-                    feature['properties'][key] = ''
-        for media_key in media_keys:
-            if feature.get('properties').get(media_key):
-                urls = []
-                if type(feature.get('properties').get(media_key)) == list:
-                    asset_uids = feature.get('properties').get(media_key)
-                else:
-                    asset_uids = feature.get('properties').get(media_key).split(',')
-                for asset_uid in asset_uids:
-                    asset, created = write_asset_from_file(asset_uid,
-                                                           media_keys[media_key],
-                                                           os.path.dirname(file_path))
-                    if asset:
-                        if asset.asset_data:
-                            if getattr(settings, 'FILESERVICE_CONFIG', {}).get('url_template'):
-                                urls += ['{}{}.{}'.format(getattr(settings,
-                                                                  'FILESERVICE_CONFIG',
-                                                                  {}).get('url_template').rstrip("{}"),
-                                                          asset_uid,
-                                                          get_type_extension(media_keys[media_key]))]
-                            else:
-                                urls += [asset.asset_data.url]
-                    else:
-                        urls += [""]
-                feature['properties']['{}_url'.format(media_key)] = urls
-            elif from_file and not feature.get('properties').get(media_key):
-                feature['properties'][media_key] = ""
-                feature['properties']['{}_url'.format(media_key)] = ""
-        if feature.get('properties').get(id_field):
-            feature['properties'][nearsight_id] = feature.get('properties').get(id_field)
-        else:
-            feature['properties'][nearsight_id] = feature.get('properties').get('id')
-        feature['properties'].pop(id_field, None)
-
-        nearsight_status["status"] = "writing feature: {0} of {1} for layer: {2}".format(count+1, total, layer.layer_name)
-        write_feature(feature.get('properties').get(nearsight_id),
-                      feature.get('properties').get('version'),
-                      layer,
-                      feature)
-        uploads += [feature]
-        count += 1
-        nearsight_status["progress"]["completed"] = count
-
-    # reset progress indicator
-    nearsight_status["progress"] = { "total": 0, "completed": 0 }
 
     try:
         database_alias = 'nearsight'
@@ -405,8 +536,72 @@ def upload_geojson(zip_path=None, file_path=None, geojson=None, request=None):
         database_alias = None
 
     table_name = layer.layer_name
-    nearsight_status["status"] = "uploading features to GeoServer..."
-    if upload_to_db(uploads, table_name, media_keys, database_alias=database_alias):
+    with layer_transaction(database_alias, table=table_name) as in_transaction:
+        for feature in features:
+            if not feature:
+                continue
+            if not feature.get('geometry'):
+                continue
+            for key in field_map:
+                if key not in feature.get('properties'):
+                    feature['properties'][key] = prototype.get(key)
+                    if isinstance(feature['properties'][key], type(None)):
+                        feature['properties'][key] = ''
+            for media_key in media_keys:
+                if feature.get('properties').get(media_key):
+                    urls = []
+                    if type(feature.get('properties').get(media_key)) == list:
+                        asset_uids = feature.get('properties').get(media_key)
+                    else:
+                        asset_uids = feature.get('properties').get(media_key).split(',')
+                    for asset_uid in asset_uids:
+                        asset, created = write_asset_from_file(asset_uid,
+                                                               media_keys[media_key],
+                                                               os.path.dirname(file_path),
+                                                               skip_errors=in_transaction)
+                        if asset:
+                            if asset.asset_data:
+                                if getattr(settings, 'FILESERVICE_CONFIG', {}).get('url_template'):
+                                    urls += ['{}{}.{}'.format(getattr(settings,
+                                                                      'FILESERVICE_CONFIG',
+                                                                      {}).get('url_template').rstrip("{}"),
+                                                              asset_uid,
+                                                              get_type_extension(media_keys[media_key]))]
+                                else:
+                                    urls += [asset.asset_data.url]
+                        else:
+                            urls += [""]
+                    feature['properties']['{}_url'.format(media_key)] = urls
+                elif from_file and not feature.get('properties').get(media_key):
+                    feature['properties'][media_key] = ""
+                    feature['properties']['{}_url'.format(media_key)] = ""
+            if feature.get('properties').get(id_field):
+                feature['properties'][nearsight_id] = feature.get('properties').get(id_field)
+            else:
+                feature['properties'][nearsight_id] = feature.get('properties').get('id')
+            feature['properties'].pop(id_field, None)
+
+            nearsight_status["status"] = "writing feature: {0} of {1} for layer: {2}".format(count+1, total, layer.layer_name)
+            if not write_feature(feature.get('properties').get(nearsight_id),
+                                 feature.get('properties').get('version'),
+                                 layer,
+                                 feature,
+                                 skip_errors=in_transaction):
+                continue
+            uploads += [feature]
+            count += 1
+            nearsight_status["progress"]["completed"] = count
+
+        # reset progress indicator
+        nearsight_status["progress"] = { "total": 0, "completed": 0 }
+
+        nearsight_status["status"] = "uploading features to GeoServer..."
+        uploaded = upload_to_db(uploads, table_name, media_keys, database_alias=database_alias)
+        if not uploaded and in_transaction:
+            rollback_layer_transaction(database_alias)
+
+    # GeoServer reads the table with its own connection, so the layer is published once the load is committed.
+    if uploaded:
         nearsight_status["status"] = "publishing layer to GeoServer ..."
         gs_layer, _ = publish_layer(table_name, database_alias=database_alias)
         if gs_layer is None:
@@ -536,17 +731,6 @@ def upload_csv(zip_path=None, file_path=None, geojson=None, request=None):
     total = len(features_list)
     row_count = 0
     nearsight_status["progress"]["total"] = row_count
-    for feature in features_list:
-        row_count += 1
-        nearsight_status["progress"]["completed"] = row_count
-        nearsight_status["status"] = "writing feature: {0} of {1} for layer: {2}".format(row_count, total, layer.layer_name)
-        write_feature(feature.get('properties').get(nearsight_id),
-                    1,
-                    layer,
-                    feature)
-
-    # reset progress indicator
-    nearsight_status["progress"] = { "total": 0, "completed": 0 }
 
     try:
         database_alias = 'nearsight'
@@ -555,8 +739,28 @@ def upload_csv(zip_path=None, file_path=None, geojson=None, request=None):
         database_alias = None
 
     table_name = layer.layer_name
-    nearsight_status["status"] = "uploading features to GeoServer..."
-    if upload_to_db(features_list, table_name, media, database_alias=database_alias):
+    uploads = []
+    with layer_transaction(database_alias, table=table_name) as in_transaction:
+        for feature in features_list:
+            row_count += 1
+            nearsight_status["progress"]["completed"] = row_count
+            nearsight_status["status"] = "writing feature: {0} of {1} for layer: {2}".format(row_count, total, layer.layer_name)
+            if write_feature(feature.get('properties').get(nearsight_id),
+                             1,
+                             layer,
+                             feature,
+                             skip_errors=in_transaction):
+                uploads += [feature]
+
+        # reset progress indicator
+        nearsight_status["progress"] = { "total": 0, "completed": 0 }
+
+        nearsight_status["status"] = "uploading features to GeoServer..."
+        uploaded = upload_to_db(uploads, table_name, media, database_alias=database_alias)
+        if not uploaded and in_transaction:
+            rollback_layer_transaction(database_alias)
+
+    if uploaded:
         nearsight_status["status"] = "publishing layer to GeoServer ..."
         gs_layer, _ = publish_layer(table_name, database_alias=database_alias)
         if gs_layer is None:
@@ -651,7 +855,7 @@ def write_layer(name, layer_id='', date=0, layer_source_zip=None, media_keys=Non
             return layer, False
 
 
-def write_feature(key, version, layer, feature_data):
+def write_feature(key, version, layer, feature_data, skip_errors=False):
     """
 
     Args:
@@ -659,22 +863,31 @@ def write_feature(key, version, layer, feature_data):
         version: A version number for the feature as an integer, usually provided by NearSight.
         layer: The layer model object, which represents the NearSight App (AKA the layer).
         feature_data: The actual feature data as a dict, mapped like a geojson.
+        skip_errors: True to return None if the feature can't be written, for use in a layer transaction.
 
     Returns:
-        The feature model object.
+        The feature model object, or None if it couldn't be written and skip_errors is set.
     """
     global nearsight_status
 
     if key is None:
         key = uuid.uuid4()
 
-    with transaction.atomic():
-        logger.debug("write_feature({0}, {1}, {2}, {3})".format(key, version, layer, feature_data))
-        feature, feature_created = Feature.objects.get_or_create(feature_uid=key,
-                                                                 feature_version=version,
-                                                                 defaults={'layer': layer,
-                                                                           'feature_data': json.dumps(feature_data)})
-        return feature
+    try:
+        with transaction.atomic():
+            logger.debug("write_feature({0}, {1}, {2}, {3})".format(key, version, layer, feature_data))
+            feature, feature_created = Feature.objects.get_or_create(feature_uid=key,
+                                                                     feature_version=version,
+                                                                     defaults={'layer': layer,
+                                                                               'feature_data': json.dumps(feature_data)})
+            return feature
+    except DatabaseError as de:
+        if not skip_errors:
+            raise
+        # Only this feature's savepoint is rolled back, so the layer transaction can carry on without it.
+        logger.error("Unable to write the feature {0} version {1}, it was skipped.".format(key, version))
+        logger.error(de)
+        return None
 
 
 
@@ -708,7 +921,7 @@ def get_nearsight_id_fieldname():
     return "nearsight_id"
 
 
-def write_asset_from_file(asset_uid, asset_type, file_dir):
+def write_asset_from_file(asset_uid, asset_type, file_dir, skip_errors=False):
     """
 
     Args:
@@ -716,72 +929,246 @@ def write_asset_from_file(asset_uid, asset_type, file_dir):
         asset_type: A string of 'Photos', 'Videos', or 'Audio'.
         from the nearsight site based on the UID and type.
         file_dir: A string for the file directory.
+        skip_errors: True to return (None, False) if the asset can't be written, for use in a layer transaction.
 
     Returns:
         A tuple of the asset model object, and a boolean representing 'was created'.
     """
     file_path = os.path.join(file_dir, '{}.{}'.format(asset_uid, get_type_extension(asset_type)))
-    with transaction.atomic():
-        asset, created = Asset.objects.get_or_create(asset_uid=asset_uid, asset_type=asset_type)
-        if created:
-            if os.path.isfile(file_path):
-                with open(file_path, 'rb') as open_file:
-                    logger.debug("writing file: {0}".format(file_path))
-                    try:
-                        asset.asset_data.save(asset_uid, File(open_file))
-                    except Exception as e:
-                        logger.error("THERE WAS AN ERROR SAVING FILE {0}".format(file_path))
-                        logger.error(e)
-            else:
-                logger.info("The file {} was not found, and is most likely missing from the archive, "
-                      "or was filtered out (if using filters).".format(file_path))
-                return None, False
-        return asset, created
+    try:
+        with transaction.atomic():
+            asset, created = Asset.objects.get_or_create(asset_uid=asset_uid, asset_type=asset_type)
+            if created:
+                if os.path.isfile(file_path):
+                    with open(file_path, 'rb') as open_file:
+                        logger.debug("writing file: {0}".format(file_path))
+                        try:
+                            asset.asset_data.save(asset_uid, File(open_file))
+                        except Exception as e:
+                            logger.error("THERE WAS AN ERROR SAVING FILE {0}".format(file_path))
+                            logger.error(e)
+                    if asset_type == 'photos':
+                        set_asset_location(asset, read_photo_gps(file_path))
+                else:
+                    logger.info("The file {} was not found, and is most likely missing from the archive, "
+                          "or was filtered out (if using filters).".format(file_path))
+                    return None, False
+            return asset, created
+    except DatabaseError as de:
+        if not skip_errors:
+            raise
+        logger.error("Unable to write the asset {0}, it was skipped.".format(asset_uid))
+        logger.error(de)
+        return None, False
+
+
+def find_invalid_assets(assets, filter_name=None, run_once=False):
+    """Filters the stored locations of the assets, the asset files are only read for assets ingested
+    before their location was stored.
+
+    Only the location filters are used, the other filters (e.g. text or phone numbers) would only see the asset uid.
 
+    Args:
+        assets: A queryset of Asset objects.
+        filter_name: The name of a filter to use if None all active filters are used (default:None)
+        run_once: Run the filter one time without being active.
+
+    Returns:
+        A list of the asset uids of the assets whose location failed a filter.
+    """
+    read_asset_locations(assets.filter(asset_type='photos', asset_location_read=False))
+    features = []
+    for asset_uid, latitude, longitude in assets.filter(asset_latitude__isnull=False).values_list(
+            'asset_uid', 'asset_latitude', 'asset_longitude').iterator():
+        features += [{"type": "Feature",
+                      "geometry": {"type": "Point",
+                                   "coordinates": [longitude, latitude]
+                                   },
+                      "properties": {"asset_uid": asset_uid}
+                      }]
+    logger.info("Filtering the locations of {0} assets".format(len(features)))
+    geojson = {"type": "FeatureCollection", "features": features}
+    return [feature.get('properties').get('asset_uid')
+            for feature in run_filters.get_failed_features(geojson, filter_name=filter_name, run_once=run_once,
+                                                           location_only=True)]
+
+
+def read_asset_locations(assets):
+    """Reads the location of each photo on a pool of threads, and stores it on the asset.
+
+    Args:
+        assets: A queryset of photo Asset objects.
+
+    Returns:
+        None
+    """
+    assets = [asset for asset in assets if asset.asset_data]
+    if not assets:
+        return
+    pool = ThreadPool(int(getattr(settings, 'NEARSIGHT_ASSET_THREADS', 8)))
+    try:
+        photo_coords = pool.map(read_photo_gps, [asset.asset_data.path for asset in assets])
+    finally:
+        pool.close()
+        pool.join()
+    for asset, coords in zip(assets, photo_coords):
+        set_asset_location(asset, coords)
 
-def is_valid_photo(photo_file_path, **kwargs):
+
+def set_asset_location(asset, coords):
     """
     Args:
-        photo_file_path: A File object of a photo:
+        asset: An Asset object.
+        coords: An array of coordinates in Decimal Degrees from read_photo_gps, or None.
 
     Returns:
-         True if the photo does not contain us-coords.
-         False if the photo does contain us-coords.
+        None
     """
-    # https://gist.github.com/erans/983821#file-get_lat_lon_exif_pil-py-L40
+    asset.asset_latitude, asset.asset_longitude = coords if coords else (None, None)
+    asset.asset_location_read = True
+    Asset.objects.filter(asset_uid=asset.asset_uid).update(asset_latitude=asset.asset_latitude,
+                                                           asset_longitude=asset.asset_longitude,
+                                                           asset_location_read=True)
+
+
+def read_photo_gps(photo_file_path):
+    """Reads the location from the EXIF header of a JPEG photo, without reading or decoding the image data.
 
-    info = None
+    Args:
+        photo_file_path: The path of a photo file.
+
+    Returns:
+         An array of coordinates in Decimal Degrees, or None if the photo has no location.
+    """
     try:
-        im = Image.open(photo_file_path)
-        info = im._getexif()
-    except Exception as e:
-        logger.warn("Failed to get exif data")
-        logger.warn(e)
-    if info:
-        properties = get_gps_info(info)
-    else:
-        return True
-    if properties.get('GPSInfo'):
-        coords = get_gps_coords(properties)
-        if coords:
-            features = []
-            feature = {"type": "Feature",
-                       "geometry": {"type": "Point",
-                                    "coordinates": [coords[1], coords[0]]
-                                    },
-                       "properties": properties
-                       }
-            features += [feature]
-            geojson = {"type": "FeatureCollection", "features": features}
-            filtered_features, count = filter_features(geojson, **kwargs)
-            if filtered_features:
-                return True
-            else:
-                return False
+        with open(photo_file_path, 'rb') as photo_file:
+            tiff_data = read_jpeg_exif(photo_file)
+    except IOError as ioe:
+        logger.warn("Failed to read {0}".format(photo_file_path))
+        logger.warn(ioe)
+        return None
+    if not tiff_data:
+        return None
+    try:
+        return get_exif_gps_coords(tiff_data)
+    except (struct.error, KeyError, IndexError, ValueError, ZeroDivisionError):
+        logger.warn("Failed to get exif data from {0}".format(photo_file_path))
+        return None
+
+
+def read_jpeg_exif(photo_file):
+    """
+    Args:
+        photo_file: An open JPEG file.
+
+    Returns:
+        The TIFF structured data from the EXIF (APP1) segment, or None if the file doesn't have one.
+    """
+    if photo_file.read(2) != b'\xff\xd8':
+        return None
+    while True:
+        marker = photo_file.read(2)
+        if len(marker) < 2 or marker[0] != b'\xff':
+            return None
+        # The image data begins at the start of scan (or end of image) marker, there is no EXIF after it.
+        if marker[1] in [b'\xda', b'\xd9']:
+            return None
+        length_bytes = photo_file.read(2)
+        if len(length_bytes) < 2:
+            return None
+        length = struct.unpack('>H', length_bytes)[0]
+        if marker[1] == b'\xe1':
+            segment = photo_file.read(length - 2)
+            if segment.startswith(b'Exif\x00\x00'):
+                return segment[6:]
         else:
-            return True
+            photo_file.seek(length - 2, os.SEEK_CUR)
+
+
+def get_exif_gps_coords(tiff_data):
+    """
+    Args:
+        tiff_data: The TIFF structured data from an EXIF segment.
+
+    Returns:
+         An array of coordinates in Decimal Degrees, or None if there is no GPS information:
+    """
+    if tiff_data[:2] == b'II':
+        byte_order = '<'
+    elif tiff_data[:2] == b'MM':
+        byte_order = '>'
     else:
-        return True
+        return None
+    ifd_offset = struct.unpack(byte_order + 'I', tiff_data[4:8])[0]
+    gps_pointer = read_exif_ifd(tiff_data, ifd_offset, byte_order).get(0x8825)
+    if not gps_pointer:
+        return None
+    gps_info = read_exif_ifd(tiff_data, struct.unpack(byte_order + 'I', gps_pointer[2])[0], byte_order)
+    if not all(tag in gps_info for tag in [1, 2, 3, 4]):
+        logger.warn("Could not get lat/long")
+        return None
+
+    lat = convert_to_degrees(read_exif_rationals(tiff_data, gps_info[2], byte_order))
+    if read_exif_ascii(tiff_data, gps_info[1], byte_order) != "N":
+        lat = 0 - lat
+
+    lon = convert_to_degrees(read_exif_rationals(tiff_data, gps_info[4], byte_order))
+    if read_exif_ascii(tiff_data, gps_info[3], byte_order) != "E":
+        lon = 0 - lon
+
+    return [round(lat, 6), round(lon, 6)]
+
+
+def read_exif_ifd(tiff_data, offset, byte_order):
+    """
+    Args:
+        tiff_data: The TIFF structured data from an EXIF segment.
+        offset: The offset of an image file directory in the data.
+        byte_order: The struct byte order character.
+
+    Returns:
+        A dict of the tags in the directory, where each value is a tuple of (type, count, 4 value/offset bytes).
+    """
+    entry_count = struct.unpack(byte_order + 'H', tiff_data[offset:offset + 2])[0]
+    entries = {}
+    for index in xrange(entry_count):
+        entry = tiff_data[offset + 2 + index * 12:offset + 14 + index * 12]
+        tag, value_type, value_count = struct.unpack(byte_order + 'HHI', entry[:8])
+        entries[tag] = (value_type, value_count, entry[8:12])
+    return entries
+
+
+def read_exif_ascii(tiff_data, entry, byte_order):
+    """
+    Args:
+        tiff_data: The TIFF structured data from an EXIF segment.
+        entry: An ASCII entry from read_exif_ifd.
+        byte_order: The struct byte order character.
+
+    Returns:
+        The string value of the entry.
+    """
+    value_type, value_count, value = entry
+    if value_count > 4:
+        offset = struct.unpack(byte_order + 'I', value)[0]
+        value = tiff_data[offset:offset + value_count]
+    return value[:value_count].rstrip(b'\x00')
+
+
+def read_exif_rationals(tiff_data, entry, byte_order):
+    """
+    Args:
+        tiff_data: The TIFF structured data from an EXIF segment.
+        entry: A rational entry from read_exif_ifd (e.g. degrees, minutes, seconds).
+        byte_order: The struct byte order character.
+
+    Returns:
+        A list of (numerator, denominator) tuples, see convert_to_degrees.
+    """
+    value_type, value_count, value = entry
+    offset = struct.unpack(byte_order + 'I', value)[0]
+    values = struct.unpack(byte_order + 'I' * (2 * value_count), tiff_data[offset:offset + 8 * value_count])
+    return [(values[index], values[index + 1]) for index in xrange(0, len(values), 2)]
 
 
 def get_gps_info(info):
@@ -898,6 +1285,12 @@ def upload_to_db(feature_data, table, media_keys, database_alias=None):
     Returns:
         True, if no errors occurred.
     """
+    with LayerSession(database_alias):
+        return load_layer(feature_data, table, media_keys, database_alias=database_alias)
+
+
+def load_layer(feature_data, table, media_keys, database_alias=None):
+    """See upload_to_db."""
     if not is_db_supported(database_alias):
         return False
 
@@ -911,20 +1304,51 @@ def upload_to_db(feature_data, table, media_keys, database_alias=None):
         feature_data = prepare_features_for_geonode(feature_data, media_keys=media_keys)
 
     key_name = get_nearsight_id_fieldname()
+    feature_count = len(feature_data)
+
+    # Drop superseded versions in memory before making a ton of calls to the server.
+    feature_data, superseded_count = get_duplicate_features(features=feature_data, properties_id=key_name)
+    if superseded_count:
+        logger.info("Dropped {0} superseded feature versions from the upload to {1}.".format(superseded_count,
+                                                                                            table))
 
-    # Sort the data in memory before making a ton of calls to the server.
-    feature_data, non_unique_features = get_duplicate_features(features=feature_data, properties_id=key_name)
+    # A table remembered by table_exists may have been dropped since, its columns are read for the load anyway.
+    if table_exists(table=table, database_alias=database_alias) and \
+            not get_layer_session(database_alias).get_columns(table):
+        forget_table_exists(database_alias=database_alias, table=table)
+        indexed_tables.discard((database_alias or None, table.lower()))
 
-    # Use ogr2ogr to create a table and add an index, before any non unique values are added.
+    # Use ogr2ogr to create a table and add an index, before the rest of the features are added.
     if not table_exists(table=table, database_alias=database_alias):
-        ogr2ogr_geojson_to_db(geojson_file=features_to_file(feature_data[0]),
-                              database_alias=database_alias,
-                              table=table)
-        add_unique_constraint(database_alias=database_alias, table=table, key_name=key_name)
+        ogr2ogr_features_to_db(feature_data[0],
+                               database_alias=database_alias,
+                               table=table)
+        set_up_layer_table(database_alias=database_alias, table=table, key_name=key_name,
+                           partitioning=getattr(settings, 'NEARSIGHT_LAYER_PARTITIONING', None),
+                           features=feature_data)
         if len(feature_data) > 1:
             feature_data = feature_data[1:]
         else:
             feature_data = None
+    add_layer_indexes(database_alias=database_alias, table=table)
+
+    # Tables partitioned by time can't have a unique nearsight_id, so they are updated by replacing rows.
+    is_time_partitioned = get_layer_session(database_alias).get_partitioning(table) == 'range'
+    if is_time_partitioned:
+        add_month_partitions(database_alias=database_alias, table=table, features=feature_data)
+
+    # Copy the features to a staging table and merge them in batches, the database rejects older versions.
+    remaining_features = stage_features_to_db(feature_data, table, database_alias=database_alias)
+    if not remaining_features:
+        analyze_layer(database_alias=database_alias, table=table, feature_count=feature_count)
+        return True
+
+    # Insert or update the features which couldn't be merged with one statement per batch.
+    if not is_time_partitioned and upsert_features_to_db(remaining_features, table, database_alias=database_alias):
+        analyze_layer(database_alias=database_alias, table=table, feature_count=feature_count)
+        return True
+
+    feature_data = remaining_features
 
     # Try to upload the presumed unique values in bulk.
     uploaded = False
@@ -938,29 +1362,18 @@ def upload_to_db(feature_data, table, media_keys, database_alias=None):
             update_db_features(non_unique_feature_data, table, database_alias=database_alias)
 
         if feature_data:
-            ogr2ogr_geojson_to_db(geojson_file=features_to_file(feature_data),
-                                  database_alias=database_alias,
-                                  table=table)
+            if not load_features_to_db(feature_data, table, database_alias=database_alias):
+                logger.error("Unable to load {0} features to {1}.".format(len(feature_data), table))
+                return False
         else:
             uploaded = True
 
-    # Finally update one by one all of the features we know are in the database
-    if non_unique_features:
-        update_db_features(non_unique_features, table, database_alias=database_alias)
+    analyze_layer(database_alias=database_alias, table=table, feature_count=feature_count)
     return True
 
 
 def is_db_supported(database_alias=None):
-    if database_alias:
-        db_conn = connections[database_alias]
-    else:
-        db_conn = connection
-    db_conn.close()
-
-    if 'postgis' not in db_conn.settings_dict.get('ENGINE') and 'postgres' not in db_conn.settings_dict.get('ENGINE'):
-        return False
-    else:
-        return True
+    return get_layer_session(database_alias).is_supported()
 
 
 def prepare_features_for_geonode(feature_data, media_keys=None):
@@ -1060,31 +1473,75 @@ def features_to_file(features, file_path=None):
 
     Args:
         features: A list of features.
-        file_path: The path to write the file to.
+        file_path: The path to write the file to, if None a new temporary file is created in the data directory,
+            which the caller should remove.
 
     Returns:
         The location of the geojson file that was written..
     """
+    if not features:
+        return None
+
     if not file_path:
         try:
-            file_path = os.path.join(get_data_dir(), 'temp.geojson')
+            file_descriptor, file_path = tempfile.mkstemp(prefix='nearsight-', suffix='.geojson', dir=get_data_dir())
+            os.close(file_descriptor)
             file_path = '/'.join(file_path.split('\\'))
-        except AttributeError:
+        except (AttributeError, OSError):
             logger.error("ERROR: Unable to write features_to_file because " \
                   "file_path AND get_data_dir() are not defined.")
+            return None
 
-    if not features:
-        return None
+    with open(file_path, 'w') as open_file:
+        json.dump(get_feature_collection(features), open_file)
+
+    return file_path
+
+
+def get_feature_collection(features):
+    """
+    Args:
+        features: A list of features, or a single feature.
 
+    Returns:
+        A geojson FeatureCollection of the features.
+    """
     if type(features) == list:
-        feature_collection = {"type": "FeatureCollection", "features": features}
-    else:
-        feature_collection = {"type": "FeatureCollection", "features": [features]}
+        return {"type": "FeatureCollection", "features": features}
+    return {"type": "FeatureCollection", "features": [features]}
 
-    with open(file_path, 'w') as open_file:
-        open_file.write(json.dumps(feature_collection))
 
-    return file_path
+def ogr2ogr_features_to_db(features, database_alias=None, table=None):
+    """Uses ogr2ogr to upload features, either streamed to ogr2ogr or written to a temporary file.
+
+    If NEARSIGHT_OGR2OGR_STDIN is set the features are sent through stdin (this requires GDAL 1.10 or later),
+    otherwise they are written to a file which is removed once ogr2ogr is done.
+
+    Args:
+        features: A list of features, or a single feature.
+        database_alias: Database dict from the django settings.
+        table: A DB table.
+
+    Returns:
+        True if the features are succesfully uploaded.
+    """
+    if not features:
+        return False
+
+    if getattr(settings, 'NEARSIGHT_OGR2OGR_STDIN', False):
+        return ogr2ogr_geojson_to_db(geojson_file='/vsistdin/',
+                                     database_alias=database_alias,
+                                     table=table,
+                                     geojson_data=json.dumps(get_feature_collection(features)))
+
+    geojson_file = features_to_file(features)
+    try:
+        return ogr2ogr_geojson_to_db(geojson_file=geojson_file,
+                                     database_alias=database_alias,
+                                     table=table)
+    finally:
+        if geojson_file and os.path.isfile(geojson_file):
+            os.remove(geojson_file)
 
 
 def get_pg_conn_string(database_alias=None):
@@ -1097,10 +1554,7 @@ def get_pg_conn_string(database_alias=None):
         A string needed to connect to postgres.
     """
 
-    if database_alias:
-        db_conn = connections[database_alias]
-    else:
-        db_conn = connection
+    db_conn = get_layer_session(database_alias).db_conn
 
     return "host={host} " \
            "port={port} " \
@@ -1113,13 +1567,14 @@ def get_pg_conn_string(database_alias=None):
                                         password=db_conn.settings_dict.get('PASSWORD'))
 
 
-def ogr2ogr_geojson_to_db(geojson_file, database_alias=None, table=None):
+def ogr2ogr_geojson_to_db(geojson_file, database_alias=None, table=None, geojson_data=None):
     """Uses an ogr2ogr script to upload a geojson file.
 
     Args:
         geojson_file: A geojson file.
         database_alias: Database dict from the django settings.
         table: A DB table.
+        geojson_data: A geojson string written to the stdin of ogr2ogr, for use with a geojson_file of '/vsistdin/'.
 
     Returns:
         True if the file is succesfully uploaded.
@@ -1128,12 +1583,8 @@ def ogr2ogr_geojson_to_db(geojson_file, database_alias=None, table=None):
     if not geojson_file:
         return False
 
-    if database_alias:
-        db_conn = connections[database_alias]
-    else:
-        db_conn = connection
-
-    if 'postgis' in db_conn.settings_dict.get('ENGINE') or 'postgres' in db_conn.settings_dict.get('ENGINE'):
+    session = get_layer_session(database_alias)
+    if session.is_supported():
         db_format = 'PostgreSQL'
         dest = "PG:'{0}'".format(get_pg_conn_string(database_alias))
         options = ['-update', '-append']
@@ -1148,8 +1599,9 @@ def ogr2ogr_geojson_to_db(geojson_file, database_alias=None, table=None):
                       '-nln', quoted_table_name] + options
     logger.debug("Executing: {0}".format(' '.join(execute_append)))
     proc = subprocess.Popen(' '.join(execute_append), shell=True, executable='/bin/bash',
+                            stdin=subprocess.PIPE if geojson_data else None,
                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    std_out, std_err = proc.communicate()
+    std_out, std_err = proc.communicate(geojson_data)
     exitcode = proc.wait()
     if exitcode != 0:
         logger.error('ogr2ogr call failed')
@@ -1157,53 +1609,962 @@ def ogr2ogr_geojson_to_db(geojson_file, database_alias=None, table=None):
         logger.error('{0}'.format(std_err))
         logger.error('ogr2ogr returned: {0}'.format(proc.returncode))
         return False
+    # ogr2ogr may have created the table.
+    session.forget_table(table)
     return True
 
 
-def add_unique_constraint(database_alias=None, table=None, key_name=None):
-    """Adds a unique constraint to a table.
+def stage_features_to_db(features, table, database_alias=None):
+    """Loads the features through an unlogged staging table, committing each batch of
+    NEARSIGHT_LOAD_BATCH_SIZE features as it is merged (see merge_features_to_db).
+    Large loads are copied by a pool of processes and merged once (see load_in_pool).
 
     Args:
+        features: A list of features.
+        table: An existing DB table.
         database_alias: Database dict from the django settings.
-        table: A DB tables
-        key_name: The column to create the unique index on.
 
     Returns:
-        None
+        A list of the features which were not loaded, starting with the first batch that could not be merged.
     """
-    if not is_alnum(table):
-        return None
-
-    if database_alias:
-        db_conn = connections[database_alias]
-    else:
-        db_conn = connection
-
-    cur = db_conn.cursor()
-
-    if 'postgis' in db_conn.settings_dict.get('ENGINE') or 'postgres' in db_conn.settings_dict.get('ENGINE'):
-        query = "ALTER TABLE {} ADD UNIQUE({});".format(table, key_name)
-    else:
-        return False
-    #
-    # if 'sqlite' in db_conn.settings_dict.get('NAME'):
-    #     query = "CREATE UNIQUE INDEX unique_{key_name} on {table}({key_name})".format(table=table, key_name=key_name)
-    # else:
-    #     query = "ALTER TABLE {} ADD UNIQUE({});".format(table, key_name)
-
+    if not features:
+        return []
+
+    staging_table = create_staging_table(database_alias=database_alias, table=table)
+    if not staging_table:
+        return features
+
+    processes = get_load_process_count(len(features), database_alias=database_alias)
+    if processes > 1:
+        if load_in_pool(features, table, staging_table, processes, database_alias=database_alias):
+            drop_staging_table(database_alias=database_alias, staging_table=staging_table)
+            return []
+        # Start again with an empty staging table.
+        drop_staging_table(database_alias=database_alias, staging_table=staging_table)
+        staging_table = create_staging_table(database_alias=database_alias, table=table)
+        if not staging_table:
+            return features
+
+    batch_size = int(getattr(settings, 'NEARSIGHT_LOAD_BATCH_SIZE', 10000))
     try:
-        with transaction.atomic():
-            cur.execute(query)
-    except ProgrammingError as pe:
-        logger.error("Unable to add a key because {} was not created yet.".format(table))
-        logger.error(pe)
+        for index in xrange(0, len(features), batch_size):
+            if not merge_features_to_db(features[index:index + batch_size], table, staging_table,
+                                        database_alias=database_alias):
+                return features[index:]
     finally:
-        cur.close()
-        db_conn.close()
+        drop_staging_table(database_alias=database_alias, staging_table=staging_table)
+    return []
 
 
-def table_exists(database_alias=None, table=None):
+def get_load_process_count(feature_count, database_alias=None):
     """
+    Args:
+        feature_count: The number of features to load.
+        database_alias: Database dict from the django settings.
+
+    Returns:
+        The number of processes to copy the features with, see NEARSIGHT_LOAD_PARALLEL_THRESHOLD.
+    """
+    if feature_count < int(getattr(settings, 'NEARSIGHT_LOAD_PARALLEL_THRESHOLD', 50000)):
+        return 1
+    # The workers use their own connections, which can't see (or commit) a transaction the caller has open.
+    if get_layer_session(database_alias).db_conn.in_atomic_block:
+        return 1
+    processes = int(getattr(settings, 'NEARSIGHT_LOAD_PROCESSES', None) or cpu_count())
+    return max(1, min(processes, feature_count))
+
+
+def load_in_pool(features, table, staging_table, processes, database_alias=None, threads=None):
+    """Splits the features into shards by the hash of their nearsight_id, which are copied to the staging table
+    by a pool of forked processes each with its own connection, then merges the staging table once.
+
+    Daemonic processes (e.g. celery prefork workers) can't start a process pool,
+    so they copy the shards on a pool of threads instead, which also each have their own connection.
+
+    Args:
+        features: A list of features.
+        table: An existing DB table.
+        staging_table: A table from create_staging_table.
+        processes: The number of processes (or threads) in the pool.
+        database_alias: Database dict from the django settings.
+        threads: True to use a pool of threads, False for processes, None to use threads in a daemonic process.
+
+    Returns:
+        True if the features were merged, if not the staging table may hold some of the features.
+    """
+    global worker_load
+
+    key_name = get_nearsight_id_fieldname()
+    shards = [[] for _ in xrange(processes)]
+    for feature in features:
+        shards[get_shard(feature.get('properties').get(key_name), processes)].append(feature)
+
+    if threads is None:
+        threads = current_process().daemon
+        if threads:
+            logger.info("Loading {0} on a pool of threads, because this process can't start "
+                        "a process pool.".format(table))
+
+    if not threads:
+        # Each process has to open its own connection, rather than share the socket of this one.
+        get_layer_session(database_alias).db_conn.close()
+    worker_load = (staging_table, database_alias)
+    pool = None
+    try:
+        if threads:
+            pool = ThreadPool(processes)
+        else:
+            pool = Pool(processes=processes)
+        copied = pool.map(copy_shard, [shard for shard in shards if shard])
+    except (AssertionError, OSError) as e:
+        logger.warn("Unable to load {0} in a pool, loading in a single process.".format(table))
+        logger.warn(repr(e))
+        return False
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        worker_load = None
+
+    if not all(copied):
+        return False
+    return merge_staging_table(database_alias=database_alias, table=table, staging_table=staging_table)
+
+
+def copy_shard(shard):
+    """
+    Args:
+        shard: A list of features.
+
+    Returns:
+        True if the shard was copied to the staging table, see load_in_pool.
+    """
+    staging_table, database_alias = worker_load
+    # Django connections are per thread, so a worker thread gets its own connection the same as a process.
+    session = get_layer_session(database_alias)
+    try:
+        return copy_features_to_db(shard, staging_table, database_alias=database_alias)
+    finally:
+        session.db_conn.close()
+
+
+def get_shard(feature_id, shard_count):
+    """
+    Args:
+        feature_id: A nearsight_id.
+        shard_count: The number of shards.
+
+    Returns:
+        The shard for the id, the same id is always in the same shard.
+    """
+    if isinstance(feature_id, unicode):
+        feature_id = feature_id.encode('utf-8')
+    return (zlib.crc32(str(feature_id)) & 0xffffffff) % shard_count
+
+
+def create_staging_table(database_alias=None, table=None):
+    """Creates an unlogged table with the columns of a layer table, without any constraints or ogc_fid.
+
+    Args:
+        database_alias: Database dict from the django settings.
+        table: An existing DB table.
+
+    Returns:
+        The name of the staging table, or None if it could not be created.
+    """
+    if not is_alnum(table):
+        return None
+
+    session = get_layer_session(database_alias)
+    if not session.is_supported():
+        return None
+
+    staging_table = '{0}_staging_{1}'.format(table, uuid.uuid4().hex[:8])
+    cur = session.cursor()
+    try:
+        with transaction.atomic(using=session.database_alias):
+            cur.execute("CREATE UNLOGGED TABLE {0} (LIKE {1});".format(staging_table, table))
+            cur.execute("ALTER TABLE {0} DROP COLUMN IF EXISTS ogc_fid;".format(staging_table))
+    except DatabaseError as de:
+        logger.warn("Unable to create a staging table for {}.".format(table))
+        logger.warn(de)
+        return None
+    finally:
+        cur.close()
+    return staging_table
+
+
+def drop_staging_table(database_alias=None, staging_table=None):
+    """
+    Args:
+        database_alias: Database dict from the django settings.
+        staging_table: A table from create_staging_table.
+
+    Returns:
+        None
+    """
+    if not is_alnum(staging_table):
+        return None
+
+    session = get_layer_session(database_alias)
+    cur = session.cursor()
+    try:
+        with transaction.atomic(using=session.database_alias):
+            cur.execute("DROP TABLE IF EXISTS {0};".format(staging_table))
+    except DatabaseError as de:
+        logger.error("Unable to drop the staging table {}.".format(staging_table))
+        logger.error(de)
+    finally:
+        cur.close()
+        session.forget_table(staging_table)
+
+
+def merge_features_to_db(features, table, staging_table, database_alias=None):
+    """Copies the features to the staging table and merges them into the layer table in one transaction.
+
+    Args:
+        features: A list of features.
+        table: An existing DB table.
+        staging_table: A table from create_staging_table.
+        database_alias: Database dict from the django settings.
+
+    Returns:
+        True if the features were merged, if not nothing was written.
+    """
+    session = get_layer_session(database_alias)
+    with transaction.atomic(using=session.database_alias):
+        merged = (copy_features_to_db(features, staging_table, database_alias=database_alias) and
+                  merge_staging_table(database_alias=database_alias, table=table, staging_table=staging_table))
+        if not merged:
+            transaction.set_rollback(True, using=session.database_alias)
+    return merged
+
+
+def merge_staging_table(database_alias=None, table=None, staging_table=None):
+    """Moves the latest version of each feature in the staging table into the layer table, and empties the
+    staging table.  Features older than their row in the layer table are rejected.
+
+    Tables with a unique nearsight_id are merged with INSERT ... ON CONFLICT,
+    tables partitioned by time (which can't have one) have their older rows deleted before the insert.
+
+    Args:
+        database_alias: Database dict from the django settings.
+        table: An existing DB table.
+        staging_table: A table from create_staging_table.
+
+    Returns:
+        True if the staging table was merged.
+    """
+    session = get_layer_session(database_alias)
+    db_conn = session.db_conn
+    columns = session.get_columns(table)
+    key_name = get_nearsight_id_fieldname()
+    if key_name not in columns:
+        return False
+    property_columns, geometry_column = split_table_columns(columns)
+    merge_columns = ', '.join(db_conn.ops.quote_name(column_name)
+                              for column_name in property_columns + ([geometry_column] if geometry_column else []))
+    has_version = 'version' in columns
+    latest = "(SELECT DISTINCT ON ({key_name}) {columns} FROM {staging_table} " \
+             "ORDER BY {key_name}{version_order}, ctid DESC) AS latest".format(
+                 key_name=key_name, columns=merge_columns, staging_table=staging_table,
+                 version_order=", version DESC" if has_version else "")
+
+    if session.get_partitioning(table) == 'range':
+        queries = ["DELETE FROM {table} AS existing USING {latest} "
+                   "WHERE existing.{key_name} = latest.{key_name}{version_check};".format(
+                       table=table, latest=latest, key_name=key_name,
+                       version_check=" AND existing.version <= latest.version" if has_version else ""),
+                   "INSERT INTO {table} ({columns}) SELECT {columns} FROM {latest} "
+                   "WHERE NOT EXISTS (SELECT 1 FROM {table} AS existing "
+                   "WHERE existing.{key_name} = latest.{key_name});".format(
+                       table=table, columns=merge_columns, latest=latest, key_name=key_name)]
+    else:
+        queries = ["INSERT INTO {table} AS existing ({columns}) SELECT {columns} FROM {latest} "
+                   "ON CONFLICT ({key_name}) DO UPDATE SET {updates}{version_check};".format(
+                       table=table, columns=merge_columns, latest=latest, key_name=key_name,
+                       updates=', '.join("{0} = EXCLUDED.{0}".format(db_conn.ops.quote_name(column_name))
+                                         for column_name in property_columns + [geometry_column]
+                                         if column_name and column_name != key_name),
+                       version_check=" WHERE existing.version <= EXCLUDED.version" if has_version else "")]
+    queries += ["TRUNCATE {0};".format(staging_table)]
+
+    cur = session.cursor()
+    try:
+        with transaction.atomic(using=session.database_alias):
+            for query in queries:
+                cur.execute(query)
+    except DatabaseError as de:
+        logger.warn("Unable to merge {0} into {1}.".format(staging_table, table))
+        logger.warn(de)
+        return False
+    finally:
+        cur.close()
+    return True
+
+
+def upsert_features_to_db(features, table, database_alias=None):
+    """Inserts the features, or updates the rows with the same nearsight_id, with one statement per batch.
+
+    Rows are only updated when the feature version is at least the version in the table, so older versions
+    are rejected (see check_db_for_feature).  If a feature appears more than once only its latest version is used.
+
+    Args:
+        features: A list of features.
+        table: An existing DB table with a unique nearsight_id (see add_unique_constraint).
+        database_alias: Database dict from the django settings.
+
+    Returns:
+        True if the features were written, False if nothing was written.
+    """
+    if not features or not is_alnum(table):
+        return False
+
+    session = get_layer_session(database_alias)
+    if not session.is_supported():
+        return False
+    db_conn = session.db_conn
+
+    key_name = get_nearsight_id_fieldname()
+    latest_features = {}
+    for feature in features:
+        feature_id = feature.get('properties').get(key_name)
+        latest_feature = latest_features.get(feature_id)
+        if not latest_feature or get_feature_version(feature) >= get_feature_version(latest_feature):
+            latest_features[feature_id] = feature
+
+    cur = session.cursor()
+    try:
+        with transaction.atomic(using=database_alias):
+            columns = session.get_columns(table)
+            if key_name not in columns:
+                return False
+            property_columns, geometry_column = split_table_columns(columns)
+            insert_columns = property_columns + ([geometry_column] if geometry_column else [])
+            row_placeholder = "({0})".format(', '.join(['%s'] * len(property_columns) +
+                                                       (['%s::geometry'] if geometry_column else [])))
+            query = "INSERT INTO {table} AS existing ({columns}) VALUES {{rows}} " \
+                    "ON CONFLICT ({key_name}) DO UPDATE SET {updates}{version_check};".format(
+                        table=table,
+                        columns=', '.join(db_conn.ops.quote_name(column_name) for column_name in insert_columns),
+                        key_name=db_conn.ops.quote_name(key_name),
+                        updates=', '.join("{0} = EXCLUDED.{0}".format(db_conn.ops.quote_name(column_name))
+                                          for column_name in insert_columns if column_name != key_name),
+                        version_check=" WHERE existing.version <= EXCLUDED.version" if 'version' in columns else "")
+            for feature_chunk in chunks(latest_features.values(), 1000):
+                params = []
+                for feature in feature_chunk:
+                    properties = dict((launder_column_name(key), value)
+                                      for key, value in (feature.get('properties') or {}).iteritems() if key)
+                    params += [get_column_value(properties.get(column_name), columns.get(column_name))
+                               for column_name in property_columns]
+                    if geometry_column:
+                        params += [get_ewkb(feature.get('geometry'))]
+                cur.execute(query.format(rows=', '.join([row_placeholder] * len(feature_chunk))), params)
+    except (DatabaseError, ValueError) as e:
+        logger.warn("Unable to upsert features to {0}.".format(table))
+        logger.warn(repr(e))
+        return False
+    finally:
+        cur.close()
+    return True
+
+
+def get_feature_version(feature):
+    """
+    Args:
+        feature: A feature.
+
+    Returns:
+        The version of the feature as an int, 0 if it doesn't have one.
+    """
+    try:
+        return int(feature.get('properties').get('version') or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def load_features_to_db(features, table, database_alias=None):
+    """Appends features to an existing table with COPY, using ogr2ogr if the features can't be copied.
+
+    Args:
+        features: A list of features.
+        table: A DB table, which must already exist (see ogr2ogr_geojson_to_db).
+        database_alias: Database dict from the django settings.
+
+    Returns:
+        True if the features were succesfully uploaded.
+    """
+    if not features:
+        return False
+    if type(features) != list:
+        features = [features]
+    if copy_features_to_db(features, table, database_alias=database_alias):
+        return True
+    if get_layer_session(database_alias).db_conn.in_atomic_block:
+        # ogr2ogr can't see the open transaction, and would wait on the rows locked by it.
+        logger.error("Unable to copy {0} features to {1} in a transaction.".format(len(features), table))
+        return False
+    logger.info("Unable to copy {0} features to {1}, using ogr2ogr.".format(len(features), table))
+    return ogr2ogr_features_to_db(features, database_alias=database_alias, table=table)
+
+
+def copy_features_to_db(features, table, database_alias=None):
+    """Writes the features to a table in a single COPY, with the geometries as EWKB.
+
+    Only properties matching a column in the table are written, the same as an ogr2ogr append.
+
+    Args:
+        features: A list of features.
+        table: An existing DB table.
+        database_alias: Database dict from the django settings.
+
+    Returns:
+        True if the features were copied, False if nothing was written.
+    """
+    if not features or not is_alnum(table):
+        return False
+
+    session = get_layer_session(database_alias)
+    if not session.is_supported():
+        return False
+    db_conn = session.db_conn
+
+    cur = session.cursor()
+    try:
+        with transaction.atomic(using=database_alias):
+            columns = session.get_columns(table)
+            if not columns:
+                return False
+            property_columns, geometry_column = split_table_columns(columns)
+            copy_columns = property_columns + ([geometry_column] if geometry_column else [])
+            query = "COPY {0} ({1}) FROM STDIN WITH (FORMAT csv, NULL '\\N');".format(
+                table, ', '.join(db_conn.ops.quote_name(column_name) for column_name in copy_columns))
+            cur.copy_expert(query, features_to_csv(features, property_columns, columns,
+                                                   geometry_column=geometry_column))
+    except (DatabaseError, db_conn.Database.Error, ValueError) as e:
+        logger.warn("Unable to copy features to {0}.".format(table))
+        logger.warn(repr(e))
+        return False
+    finally:
+        cur.close()
+    return True
+
+
+def features_to_csv(features, property_columns, column_types, geometry_column=None):
+    """
+    Args:
+        features: A list of features.
+        property_columns: The table columns to write from the feature properties, in order.
+        column_types: A dict of the table columns and their postgres types (see get_table_columns).
+        geometry_column: The geometry column, written last, or None if the table has no geometry.
+
+    Returns:
+        A file-like object containing a CSV row per feature, for use with COPY.
+    """
+    csv_file = StringIO()
+    writer = csv.writer(csv_file)
+    for feature in features:
+        properties = dict((launder_column_name(key), value)
+                          for key, value in (feature.get('properties') or {}).iteritems() if key)
+        row = [get_copy_value(properties.get(column_name), column_types.get(column_name))
+               for column_name in property_columns]
+        if geometry_column:
+            row += [get_ewkb(feature.get('geometry')) or '\\N']
+        writer.writerow(row)
+    csv_file.seek(0)
+    return csv_file
+
+
+def get_copy_value(value, column_type=None):
+    """
+    Args:
+        value: A property value from a feature.
+        column_type: The postgres type of the column the value is written to.
+
+    Returns:
+        The value as a utf-8 string for a COPY CSV row, where '\\N' is NULL.
+    """
+    value = get_column_value(value, column_type)
+    if value is None:
+        return '\\N'
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def get_column_value(value, column_type=None):
+    """
+    Args:
+        value: A property value from a feature.
+        column_type: The postgres type of the column the value is written to.
+
+    Returns:
+        The value to write to the column, or None for NULL.
+    """
+    if value is None:
+        return None
+    if value == '' and column_type not in ['varchar', 'text', 'bpchar']:
+        # Empty strings are used for missing values (see prepare_features_for_geonode).
+        return None
+    if isinstance(value, bool):
+        if column_type == 'bool':
+            return 'true' if value else 'false'
+        return '1' if value else '0'
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value
+
+
+def get_ewkb(geometry):
+    """
+    Args:
+        geometry: A geojson geometry.
+
+    Returns:
+        The geometry as hex encoded EWKB in EPSG:4326, or None if there is no geometry.
+    """
+    if not geometry or not geometry.get('coordinates'):
+        return None
+    return wkb.dumps(shape(geometry), hex=True, srid=4326)
+
+
+def launder_column_name(name):
+    """
+    Args:
+        name: A feature property name.
+
+    Returns:
+        The name of the column ogr2ogr creates for the property.
+    """
+    return re.sub(r"['#-]", '_', name.lower())
+
+
+def split_table_columns(columns):
+    """
+    Args:
+        columns: A dict of the column names and their postgres types (see get_table_columns).
+
+    Returns:
+        A tuple of a sorted list of the columns written from feature properties, and the geometry column (or None).
+    """
+    geometry_column = None
+    property_columns = []
+    for column_name, column_type in sorted(columns.iteritems()):
+        if column_type == 'geometry':
+            geometry_column = column_name
+        elif column_name != 'ogc_fid':
+            property_columns += [column_name]
+    return property_columns, geometry_column
+
+
+def get_table_columns(cursor, table):
+    """
+    Args:
+        cursor: A database cursor.
+        table: A DB table.
+
+    Returns:
+        A dict of the column names and their postgres types, which is empty if the table doesn't exist.
+    """
+    cursor.execute("SELECT column_name, udt_name FROM information_schema.columns "
+                   "WHERE table_name = %s AND table_schema = ANY(current_schemas(false));", [table])
+    return dict(cursor.fetchall())
+
+
+def add_unique_constraint(database_alias=None, table=None, key_name=None):
+    """Adds a unique constraint to a table.
+
+    Args:
+        database_alias: Database dict from the django settings.
+        table: A DB tables
+        key_name: The column to create the unique index on.
+
+    Returns:
+        None
+    """
+    if not is_alnum(table):
+        return None
+
+    session = get_layer_session(database_alias)
+
+    if session.is_supported():
+        query = "ALTER TABLE {} ADD UNIQUE({});".format(table, key_name)
+    else:
+        return False
+
+    cur = session.cursor()
+    #
+    # if 'sqlite' in db_conn.settings_dict.get('NAME'):
+    #     query = "CREATE UNIQUE INDEX unique_{key_name} on {table}({key_name})".format(table=table, key_name=key_name)
+    # else:
+    #     query = "ALTER TABLE {} ADD UNIQUE({});".format(table, key_name)
+
+    try:
+        with transaction.atomic(using=session.database_alias):
+            cur.execute(query)
+    except ProgrammingError as pe:
+        logger.error("Unable to add a key because {} was not created yet.".format(table))
+        logger.error(pe)
+    finally:
+        cur.close()
+
+
+def set_up_layer_table(database_alias=None, table=None, key_name=None, partitioning=None, features=None):
+    """Partitions a new layer table if partitioning is set, and adds the unique key to it,
+    unless the table was partitioned by month (which can't have a unique key on key_name alone).
+
+    Args:
+        database_alias: Database dict from the django settings.
+        table: A DB table which was just created.
+        key_name: The column to create the unique index on.
+        partitioning: None, 'hash' or 'month' (see NEARSIGHT_LAYER_PARTITIONING).
+        features: The features about to be loaded (see partition_layer_table).
+
+    Returns:
+        True if the table was partitioned by month.
+    """
+    is_month_partitioned = False
+    if partitioning:
+        partitioned = partition_layer_table(database_alias=database_alias, table=table, partitioning=partitioning,
+                                            features=features)
+        is_month_partitioned = partitioned and partitioning == 'month'
+    if not is_month_partitioned:
+        # A table which couldn't be partitioned still needs the key, which the merges rely on.
+        add_unique_constraint(database_alias=database_alias, table=table, key_name=key_name)
+    return is_month_partitioned
+
+
+def partition_layer_table(database_alias=None, table=None, partitioning=None, features=None):
+    """Replaces a new layer table with a partitioned table with the same columns and rows.
+
+    Tables are either partitioned by the hash of the nearsight_id into NEARSIGHT_LAYER_PARTITIONS partitions,
+    or by the month of updated_at (see add_month_partitions).  This requires PostgreSQL 11 or later.
+
+    Args:
+        database_alias: Database dict from the django settings.
+        table: A DB table which was just created.
+        partitioning: 'hash' or 'month'.
+        features: For 'month' the features about to be loaded, so their partitions are created up front.
+
+    Returns:
+        True if the table was partitioned.
+    """
+    if not is_alnum(table) or partitioning not in ['hash', 'month']:
+        return False
+
+    session = get_layer_session(database_alias)
+    if not session.is_supported():
+        return False
+
+    columns = session.get_columns(table)
+    if partitioning == 'month' and columns.get('updated_at') not in ['timestamp', 'timestamptz', 'date',
+                                                                      'varchar', 'text']:
+        logger.warn("The table {} can not be partitioned by month without an updated_at date.".format(table))
+        return False
+    if partitioning == 'hash' and get_nearsight_id_fieldname() not in columns:
+        return False
+
+    cur = session.cursor()
+    try:
+        with transaction.atomic(using=session.database_alias):
+            cur.execute("ALTER TABLE {0} RENAME TO {0}_initial;".format(table))
+            if partitioning == 'hash':
+                cur.execute("CREATE TABLE {0} (LIKE {0}_initial INCLUDING DEFAULTS) "
+                            "PARTITION BY HASH ({1});".format(table, get_nearsight_id_fieldname()))
+                partitions = int(getattr(settings, 'NEARSIGHT_LAYER_PARTITIONS', 16))
+                for remainder in xrange(partitions):
+                    cur.execute("CREATE TABLE {0}_p{1} PARTITION OF {0} "
+                                "FOR VALUES WITH (MODULUS {2}, REMAINDER {1});".format(table, remainder, partitions))
+            else:
+                cur.execute("CREATE TABLE {0} (LIKE {0}_initial INCLUDING DEFAULTS) "
+                            "PARTITION BY RANGE (updated_at);".format(table))
+                cur.execute("CREATE TABLE {0}_pdefault PARTITION OF {0} DEFAULT;".format(table))
+                create_month_partitions(cur, table, columns.get('updated_at'), features)
+            cur.execute("INSERT INTO {0} SELECT * FROM {0}_initial;".format(table))
+            # Keep the ogc_fid sequence when the original table is dropped.
+            cur.execute("SELECT pg_get_serial_sequence(%s, 'ogc_fid');", ['{0}_initial'.format(table)])
+            sequence = cur.fetchone()[0]
+            if sequence:
+                cur.execute("ALTER SEQUENCE {0} OWNED BY {1}.ogc_fid;".format(sequence, table))
+            cur.execute("DROP TABLE {0}_initial;".format(table))
+            # A partitioned table can only have a key which includes the partition column,
+            # so GeoServer is told to use ogc_fid as the primary key (see register_primary_key).
+            partition_column = get_nearsight_id_fieldname() if partitioning == 'hash' else 'updated_at'
+            cur.execute("ALTER TABLE {0} ADD CONSTRAINT {0}_ogc_fid_key UNIQUE (ogc_fid, {1});".format(
+                table, partition_column))
+            register_primary_key(cur, table, 'ogc_fid', sequence)
+    except DatabaseError as de:
+        logger.error("Unable to partition {}.".format(table))
+        logger.error(de)
+        return False
+    finally:
+        cur.close()
+        session.forget_table(table)
+    return True
+
+
+def register_primary_key(cursor, table, column, sequence=None):
+    """Records the primary key of a table in the GeoServer primary key metadata table (see PK_METADATA_TABLE),
+    for tables which can't have a primary key constraint on the column.
+
+    Args:
+        cursor: A database cursor.
+        table: A DB table.
+        column: The column GeoServer should use as the feature id.
+        sequence: The sequence which generates the column, so GeoServer can insert features.
+
+    Returns:
+        None
+    """
+    cursor.execute("CREATE TABLE IF NOT EXISTS {0} ("
+                   "table_schema VARCHAR(64) NOT NULL, "
+                   "table_name VARCHAR(64) NOT NULL, "
+                   "pk_column VARCHAR(64) NOT NULL, "
+                   "pk_column_idx INTEGER, "
+                   "pk_policy VARCHAR(32), "
+                   "pk_sequence VARCHAR(128), "
+                   "UNIQUE (table_schema, table_name, pk_column), "
+                   "CHECK (pk_policy IN ('sequence', 'assigned', 'autogenerated')));".format(PK_METADATA_TABLE))
+    cursor.execute("INSERT INTO {0} (table_schema, table_name, pk_column, pk_column_idx, pk_policy, pk_sequence) "
+                   "VALUES (current_schema(), %s, %s, 1, %s, %s) "
+                   "ON CONFLICT (table_schema, table_name, pk_column) DO UPDATE "
+                   "SET pk_policy = EXCLUDED.pk_policy, pk_sequence = EXCLUDED.pk_sequence;".format(PK_METADATA_TABLE),
+                   [table.lower(), column, 'sequence' if sequence else 'assigned', sequence])
+
+
+def add_month_partitions(database_alias=None, table=None, features=None):
+    """Adds the partitions for the months of the features to a table partitioned by month.
+
+    Args:
+        database_alias: Database dict from the django settings.
+        table: A DB table partitioned by updated_at.
+        features: The features about to be loaded.
+
+    Returns:
+        None
+    """
+    if not is_alnum(table) or not features:
+        return None
+
+    session = get_layer_session(database_alias)
+    cur = session.cursor()
+    try:
+        create_month_partitions(cur, table, session.get_columns(table).get('updated_at'), features)
+    finally:
+        cur.close()
+
+
+def create_month_partitions(cursor, table, column_type, features):
+    """
+    Args:
+        cursor: A database cursor.
+        table: A DB table partitioned by updated_at.
+        column_type: The postgres type of the updated_at column.
+        features: A list of features.
+
+    Returns:
+        None
+    """
+    months = set(get_feature_month(feature, column_type) for feature in features or [])
+    months.discard(None)
+    for year, month in sorted(months):
+        next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+        try:
+            with transaction.atomic(using=cursor.db.alias):
+                cursor.execute("CREATE TABLE IF NOT EXISTS {0}_p{1:04d}{2:02d} PARTITION OF {0} "
+                               "FOR VALUES FROM ('{1:04d}-{2:02d}-01') TO ('{3:04d}-{4:02d}-01');".format(
+                                   table, year, month, next_year, next_month))
+        except DatabaseError as de:
+            # The default partition may already hold rows for the month.
+            logger.warn("Unable to add the partition for {0}-{1} to {2}.".format(year, month, table))
+            logger.warn(de)
+
+
+def get_feature_month(feature, column_type=None):
+    """
+    Args:
+        feature: A feature.
+        column_type: The postgres type of the updated_at column.
+
+    Returns:
+        A tuple of the year and month of the feature's updated_at, as it is compared by the column, or None.
+    """
+    updated_at = (feature.get('properties') or {}).get('updated_at')
+    if not updated_at or not isinstance(updated_at, basestring):
+        return None
+    if column_type in ['varchar', 'text']:
+        # Text is partitioned by comparing strings, so only the written date matters.
+        match = re.match(r'(\d{4})-(\d{2})', updated_at)
+        return (int(match.group(1)), int(match.group(2))) if match else None
+    try:
+        updated_time = parser.parse(updated_at)
+    except (ValueError, OverflowError):
+        return None
+    if updated_time.tzinfo:
+        updated_time = updated_time.astimezone(pytz.utc)
+    return updated_time.year, updated_time.month
+
+
+def drop_layer_table(database_alias=None, table=None):
+    """Drops a layer table, with its partitions.
+
+    Args:
+        database_alias: Database dict from the django settings.
+        table: A DB table.
+
+    Returns:
+        True if the table was dropped.
+    """
+    if not is_alnum(table):
+        return False
+
+    session = get_layer_session(database_alias)
+    cur = session.cursor()
+    try:
+        with transaction.atomic(using=session.database_alias):
+            cur.execute("DROP TABLE IF EXISTS {0} CASCADE;".format(table))
+    except DatabaseError as de:
+        logger.error("Unable to drop {}.".format(table))
+        logger.error(de)
+        return False
+    finally:
+        cur.close()
+        session.forget_table(table)
+        forget_table_exists(database_alias=database_alias, table=table)
+    return True
+
+
+def drop_layer_partitions(database_alias=None, table=None, before=None):
+    """Drops the monthly partitions of a layer for months before a date, with their Feature models.
+
+    Args:
+        database_alias: Database dict from the django settings.
+        table: A DB table partitioned by month.
+        before: A datetime, partitions for months before its month are dropped.
+
+    Returns:
+        The number of features removed.
+    """
+    if not is_alnum(table) or not before:
+        return 0
+
+    session = get_layer_session(database_alias)
+    if session.get_partitioning(table) != 'range':
+        return 0
+
+    key_name = get_nearsight_id_fieldname()
+    partition_pattern = re.compile(r'^{0}_p(\d{{4}})(\d{{2}})$'.format(table.lower()))
+    feature_uids = []
+    cur = session.cursor()
+    try:
+        with transaction.atomic(using=session.database_alias):
+            cur.execute("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                        "WHERE i.inhparent = to_regclass(%s);", [table])
+            for (partition,) in cur.fetchall():
+                match = partition_pattern.match(partition)
+                if not match or (int(match.group(1)), int(match.group(2))) >= (before.year, before.month):
+                    continue
+                cur.execute("SELECT {0} FROM {1};".format(key_name, partition))
+                feature_uids += [row[0] for row in cur.fetchall()]
+                cur.execute("DROP TABLE {0};".format(partition))
+                logger.info("Dropped the partition {0}.".format(partition))
+    except DatabaseError as de:
+        logger.error("Unable to drop the partitions of {}.".format(table))
+        logger.error(de)
+        return 0
+    finally:
+        cur.close()
+
+    deleted_count = 0
+    for uid_chunk in chunks(feature_uids, 1000):
+        features = Feature.objects.filter(feature_uid__in=uid_chunk, layer=table)
+        deleted_count += features.count()
+        features.delete()
+    return deleted_count
+
+
+def add_layer_indexes(database_alias=None, table=None):
+    """Adds a GiST index on the geometry, and indexes on the version and update time, if the table has them.
+    Each table is only checked once per process.
+
+    Args:
+        database_alias: Database dict from the django settings.
+        table: A DB table.
+
+    Returns:
+        None
+    """
+    if not is_alnum(table):
+        return None
+
+    table_key = (database_alias or None, table.lower())
+    if table_key in indexed_tables:
+        return None
+
+    session = get_layer_session(database_alias)
+    if not session.is_supported():
+        return None
+
+    columns = session.get_columns(table)
+    if not columns:
+        return None
+    property_columns, geometry_column = split_table_columns(columns)
+    queries = []
+    if geometry_column:
+        queries += ["CREATE INDEX IF NOT EXISTS {0}_{1}_gist ON {0} USING GIST ({1});".format(table, geometry_column)]
+    for column_name in ['version', 'updated_at']:
+        if column_name in columns:
+            queries += ["CREATE INDEX IF NOT EXISTS {0}_{1}_idx ON {0} ({1});".format(table, column_name)]
+
+    cur = session.cursor()
+    try:
+        for query in queries:
+            with transaction.atomic(using=session.database_alias):
+                cur.execute(query)
+        indexed_tables.add(table_key)
+    except DatabaseError as de:
+        logger.error("Unable to add the indexes to {}.".format(table))
+        logger.error(de)
+    finally:
+        cur.close()
+
+
+def analyze_layer(database_alias=None, table=None, feature_count=0):
+    """Updates the planner statistics of a table after a large load (see NEARSIGHT_ANALYZE_THRESHOLD).
+
+    Args:
+        database_alias: Database dict from the django settings.
+        table: A DB table.
+        feature_count: The number of features that were loaded.
+
+    Returns:
+        None
+    """
+    if not is_alnum(table):
+        return None
+    if feature_count < int(getattr(settings, 'NEARSIGHT_ANALYZE_THRESHOLD', 10000)):
+        return None
+
+    session = get_layer_session(database_alias)
+    if not session.is_supported():
+        return None
+
+    cur = session.cursor()
+    try:
+        with transaction.atomic(using=session.database_alias):
+            cur.execute("ANALYZE {};".format(table))
+    except DatabaseError as de:
+        logger.error("Unable to analyze {}.".format(table))
+        logger.error(de)
+    finally:
+        cur.close()
+
+
+def table_exists(database_alias=None, table=None):
+    """Checks the catalog for a table, tables which exist are remembered for EXISTING_TABLE_SECONDS.
 
     Args:
         database_alias: Database dict from the django settings.
@@ -1215,29 +2576,56 @@ def table_exists(database_alias=None, table=None):
     if not is_alnum(table):
         return None
 
-    if database_alias:
-        db_conn = connections[database_alias]
-    else:
-        db_conn = connection
+    table_key = (database_alias or None, table.lower())
+    if time.time() - existing_tables.get(table_key, 0) < EXISTING_TABLE_SECONDS:
+        return True
 
-    cur = db_conn.cursor()
+    session = get_layer_session(database_alias)
+    cur = session.cursor()
 
-    query = "select * from {0};".format(table)
+    if session.is_supported():
+        query = "SELECT to_regclass(%s) IS NOT NULL;"
+        params = [table]
+    else:
+        query = "SELECT 1 FROM {0} LIMIT 0;".format(table)
+        params = None
 
     try:
-        with transaction.atomic():
-            cur.execute(query)
-        does_table_exist = True
+        with transaction.atomic(using=session.database_alias):
+            cur.execute(query, params)
+            if session.is_supported():
+                does_table_exist = bool(cur.fetchone()[0])
+            else:
+                does_table_exist = True
     except ProgrammingError:
         does_table_exist = False
     except OperationalError:
         does_table_exist = False
     finally:
         cur.close()
-        db_conn.close()
+    if does_table_exist:
+        existing_tables[table_key] = time.time()
+    else:
+        existing_tables.pop(table_key, None)
     return does_table_exist
 
 
+def forget_table_exists(database_alias=None, table=None):
+    """Removes a table from the tables known to exist, after it is dropped.
+
+    Args:
+        database_alias: Database dict from the django settings.
+        table: The table which was dropped, if None every table is forgotten.
+
+    Returns:
+        None
+    """
+    if table is None:
+        existing_tables.clear()
+    else:
+        existing_tables.pop((database_alias or None, table.lower()), None)
+
+
 def check_db_for_features(features, table, database_alias=None):
     """This searches a database table to see if and of the features already exist in the DB.
 
@@ -1251,7 +2639,10 @@ def check_db_for_features(features, table, database_alias=None):
     """
     if not features:
         return None
-    db_features = get_all_db_features(table, database_alias=database_alias)
+    key_name = get_nearsight_id_fieldname()
+    db_features = get_db_features(table,
+                                  [feature.get('properties').get(key_name) for feature in features],
+                                  database_alias=database_alias)
     unique_features = []
     non_unique_features = []
     for feature in features:
@@ -1266,36 +2657,33 @@ def check_db_for_features(features, table, database_alias=None):
 
 
 def get_duplicate_features(features, properties_id=None):
-    """This searches a feature list against itself for duplicate features.
+    """This searches a feature list against itself for duplicate features, keeping only the latest version of each.
 
     Args:
         features: A dict structured like a geojson of features.
         properties_id: The string representing the properties key of the feature UID.
 
     Returns:
-        A dict of unique features, and a dict of non unique features as a tuple.
+        A list of the features with the highest version for each id (the last one if versions are equal)
+        in their original order, and the number of superseded features which were dropped, as a tuple.
+        Features without an id are all kept.
     """
     if not features or not properties_id:
-        return None, None
-    if len(features) == 1:
-        return features, None
-
-    sorted_features = sort_features(sort_features(features, 'version'), properties_id)
-
-    unique_features = [sorted_features[0]]
-    non_unique_features = []
-    if not sorted_features[1]:
-        return unique_features, non_unique_features
-    for feature in sorted_features[1:]:
-        if feature.get('properties').get(properties_id) == unique_features[-1].get('properties').get(properties_id):
-            non_unique_features += [feature]
-        else:
-            unique_features += [feature]
-    return unique_features, non_unique_features
+        return None, 0
 
+    latest_features = {}
+    for feature in features:
+        feature_id = feature.get('properties').get(properties_id)
+        if feature_id is None:
+            continue
+        latest_feature = latest_features.get(feature_id)
+        if latest_feature is None or get_feature_version(feature) >= get_feature_version(latest_feature):
+            latest_features[feature_id] = feature
 
-def sort_features(features, properties_key=None):
-    return sorted(features, key=lambda (feature): feature['properties'][properties_key])
+    unique_features = [feature for feature in features
+                       if feature.get('properties').get(properties_id) is None or
+                       latest_features.get(feature.get('properties').get(properties_id)) is feature]
+    return unique_features, len(features) - len(unique_features)
 
 
 def check_db_for_feature(feature, db_features=None):
@@ -1303,7 +2691,7 @@ def check_db_for_feature(feature, db_features=None):
 
     Args:
         feature: A feature to be checked for.
-        db_features: All of the db features (see get_all_db_features).
+        db_features: The db features with ids matching the features (see get_db_features).
 
     Returns:
         The feature if it matches, otherwise None.
@@ -1322,37 +2710,37 @@ def check_db_for_feature(feature, db_features=None):
     return None
 
 
-def get_all_db_features(layer, database_alias=None):
-    """
+def get_db_features(layer, feature_ids, database_alias=None):
+    """Looks up only the rows matching the feature ids, so the cost depends on the number of ids
+    rather than the size of the table.
 
     Args:
         layer: A database table.
+        feature_ids: A list of nearsight_ids.
         database_alias: Django database object defined in the settings.
 
     Returns:
-        A dict of features (not these are NOT formatted like a geojson).
+        A dict of the nearsight_id, ogc_fid, and version of the matching rows keyed by nearsight_id,
+        or None if the table doesn't exist.
     """
     if not is_alnum(layer):
         return None
 
-    if database_alias:
-        cur = connections[database_alias].cursor()
-    else:
-        cur = connection.cursor()
+    feature_ids = list(set(feature_id for feature_id in feature_ids if feature_id is not None))
+
+    cur = get_layer_session(database_alias).cursor()
 
-    query = "SELECT * FROM {};".format(layer)
+    key_name = get_nearsight_id_fieldname()
+    query = "SELECT {0}, ogc_fid, version FROM {1} WHERE {0} = ANY(%s);".format(key_name, layer)
+    features = {}
     try:
-        with transaction.atomic():
-            cur.execute(query)
-            features = {}
-            nearsight_id_index = get_column_index(get_nearsight_id_fieldname(), cur)
-            ogc_id_index = get_column_index('ogc_fid', cur)
-            version_id_index = get_column_index('version', cur)
-            for feature in cur:
-                features[feature[nearsight_id_index]] = {get_nearsight_id_fieldname(): feature[nearsight_id_index],
-                                                       'ogc_fid': feature[ogc_id_index],
-                                                       'version': feature[version_id_index],
-                                                       'feature_data': feature}
+        with transaction.atomic(using=database_alias):
+            for id_chunk in chunks(feature_ids, 1000):
+                cur.execute(query, [id_chunk])
+                for nearsight_id, ogc_fid, version in cur.fetchall():
+                    features[nearsight_id] = {key_name: nearsight_id,
+                                              'ogc_fid': ogc_fid,
+                                              'version': version}
     except ProgrammingError:
         return None
     finally:
@@ -1360,28 +2748,14 @@ def get_all_db_features(layer, database_alias=None):
     return features
 
 
-def get_column_index(name, cursor):
-    """Checks a raw sql query description for the name of a column.
-
-    Args:
-        name: The name being searched for.
-        cursor: A database cursor.
-
-    Returns:
-        The index value for the column.
-    """
-    if not cursor.description:
-        return
-    for ind, val in enumerate([desc[0] for desc in cursor.description]):
-        if val.lower() == name.lower():
-            return ind
-
-
 def update_db_features(features, layer, database_alias=None):
-    """A wrapper to repeatedly call update_db_feature.
+    """Replaces the rows of features which exist in the database as a batch.
+
+    The existing rows are looked up with one query, features older than their row are rejected,
+    and the rows are deleted and the features copied in one transaction.
 
     Args:
-        features: A feature whose id exists in the database, to be updated.
+        features: A list of features whose ids exist in the database, to be updated.
         layer: The name of the database table.
         database_alias: The django database structure defined in settings.
 
@@ -1389,25 +2763,53 @@ def update_db_features(features, layer, database_alias=None):
         None
     """
     global nearsight_status
-    total = len(features)
-    nearsight_status["progress"] = { "total": total, "completed": 0 }
-    nearsight_status["status"] = "updating features on GeoServer"
-
 
     if not features or not layer:
         logger.info("A feature or layer was not provided to update_db_features...")
         return
+    if not is_alnum(layer):
+        return
     if type(features) != list:
         features = [features]
-    count = 0
+
+    total = len(features)
+    nearsight_status["progress"] = {"total": total, "completed": 0}
+    nearsight_status["status"] = "updating {0} features on GeoServer".format(total)
+
+    key_name = get_nearsight_id_fieldname()
+    db_features = get_db_features(layer,
+                                  [feature.get('properties').get(key_name) for feature in features],
+                                  database_alias=database_alias) or {}
+    update_features = {}
     for feature in features:
-        count += 1
-        nearsight_status["progress"] = { "total": total, "completed": count }
-        nearsight_status["status"] = "updating GeoServer feature: {0} of {1}".format(count, total)
-        update_db_feature(feature,
-                          layer,
-                          database_alias=database_alias)
-    nearsight_status["progress"] = { "total": 0, "completed": 0 }
+        feature_id = feature.get('properties').get(key_name)
+        checked_feature = check_db_for_feature(feature, db_features)
+        if checked_feature == 'reject':
+            logger.warn("WARNING: An attempt was made to update a feature with an older version. "
+                        "The feature {} was rejected.".format(feature_id))
+            continue
+        if not checked_feature:
+            logger.warn("WARNING: An attempted to update a feature that doesn't exist in the database.")
+            logger.warn(" A new entry will be created for the feature {}.".format(feature_id))
+        # Later features replace earlier features with the same id, as if they were updated in order.
+        update_features[feature_id] = feature
+
+    feature_ids = update_features.keys()
+    features = update_features.values()
+    if features:
+        with transaction.atomic(using=database_alias):
+            delete_db_features(feature_ids, layer, database_alias=database_alias)
+            copied = copy_features_to_db(features, layer, database_alias=database_alias)
+            if not copied:
+                transaction.set_rollback(True, using=database_alias)
+        if not copied and get_layer_session(database_alias).db_conn.in_atomic_block:
+            logger.error("Unable to copy {0} features to {1} in a transaction.".format(len(features), layer))
+        elif not copied:
+            # ogr2ogr uses its own connection, so it can't share the transaction.
+            logger.info("Unable to copy {0} features to {1}, using ogr2ogr.".format(len(features), layer))
+            delete_db_features(feature_ids, layer, database_alias=database_alias)
+            ogr2ogr_features_to_db(features, database_alias=database_alias, table=layer)
+    nearsight_status["progress"] = {"total": 0, "completed": 0}
 
 
 def update_db_feature(feature, layer, database_alias=None):
@@ -1421,30 +2823,10 @@ def update_db_feature(feature, layer, database_alias=None):
     Returns:
         None
     """
-    if not is_alnum(layer):
-        return
-
     if not feature:
         return
 
-    if not feature.get('ogc_fid'):
-        check_feature = check_db_for_feature(feature, get_all_db_features(layer, database_alias=database_alias))
-        if not check_feature:
-            logger.warn("WARNING: An attempted to update a feature that doesn't exist in the database.")
-            logger.warn(" A new entry will be created for the feature {}.".format(feature))
-        elif check_feature == 'reject':
-            logger.warn("WARNING: An attempt was made to update a feature with an older version. "
-                  "The feature {} was rejected.".format(feature))
-        else:
-            feature = check_feature
-
-    delete_db_feature(feature,
-                      layer=layer,
-                      database_alias=database_alias)
-
-    ogr2ogr_geojson_to_db(geojson_file=features_to_file(feature),
-                          database_alias=database_alias,
-                          table=layer)
+    update_db_features([feature], layer, database_alias=database_alias)
 
 
 def delete_db_feature(feature, layer, database_alias=None):
@@ -1458,39 +2840,12 @@ def delete_db_feature(feature, layer, database_alias=None):
     Returns:
         None
     """
-    if not is_alnum(layer):
-        return
-
     if not feature:
         return
 
-    if not feature.get('ogc_fid'):
-        check_feature = check_db_for_feature(feature, get_all_db_features(layer, database_alias=database_alias))
-        if not check_feature:
-            logger.warn("WARNING: An attempt was made to delete a feature "
-                  "that doesn't exist in the database (or have an OGC_FID.")
-        elif check_feature == 'reject':
-            logger.warn("WARNING: An attempt was made to update a feature with an older version. "
-                  "The feature {} was rejected.".format(feature))
-    if database_alias:
-        db_conn = connections[database_alias]
-    else:
-        db_conn = connection
-
-    cur = db_conn.cursor()
-
-    query = "DELETE FROM {} WHERE {} = '{}';".format(layer, get_nearsight_id_fieldname(), feature.get('properties').get(get_nearsight_id_fieldname()))
-
-    try:
-        with transaction.atomic():
-            cur.execute(query)
-    except ProgrammingError:
-        logger.error("Unable to delete the feature:")
-        logger.error(str(feature))
-        logger.error("It is most likely not in the database or missing a nearsight_id.")
-    finally:
-        cur.close()
-        db_conn.close()
+    delete_db_features([feature.get('properties').get(get_nearsight_id_fieldname())],
+                       layer,
+                       database_alias=database_alias)
 
 
 def is_alnum(data):
@@ -1590,6 +2945,8 @@ def publish_layer(layer_name, geoserver_base_url=None, database_alias=None):
                                                passwd=password,
                                                user=user,
                                                dbtype=db_type)
+        # Partitioned layer tables record their primary key here instead (see register_primary_key).
+        datastore.connection_parameters['Primary key metadata table'] = PK_METADATA_TABLE
         cat.save(datastore)
 
     # Check if remote layer already exists on local system
@@ -1752,16 +3109,131 @@ def delete_feature(feature_uid):
         feature_uid: An id (presumably the nearsight_id) of an object to remove from the nearsight database.
 
     """
+    delete_features([feature_uid])
+
+
+def delete_features(feature_uids):
+    """Removes features from their layer tables with one query per layer, then removes the Feature models.
+
+    Args:
+        feature_uids: A list of ids (presumably the nearsight_id) of objects to remove from the nearsight database.
+
+    Returns:
+        The number of Feature models removed.
+    """
     if getattr(settings, 'DATABASES', {}).get('nearsight'):
         database_alias = 'nearsight'
     else:
         database_alias = None
 
-    is_database_used = False
+    feature_uids = list(set(feature_uid for feature_uid in feature_uids if feature_uid is not None))
+    if not feature_uids:
+        return 0
+
     if is_db_supported(database_alias):
-        is_database_used = True
+        layer_uids = {}
+        for uid_chunk in chunks(feature_uids, 1000):
+            for feature_uid, layer_name in Feature.objects.filter(feature_uid__in=uid_chunk).values_list(
+                    'feature_uid', 'layer').distinct():
+                layer_uids.setdefault(layer_name, []).append(feature_uid)
+        for layer_name, uids in layer_uids.iteritems():
+            delete_db_features(uids, layer_name, database_alias=database_alias)
+
+    deleted_count = 0
+    for uid_chunk in chunks(feature_uids, 1000):
+        features = Feature.objects.filter(feature_uid__in=uid_chunk)
+        deleted_count += features.count()
+        features.delete()
+    return deleted_count
+
+
+def purge_assets(asset_uids):
+    """Removes the assets with one delete per chunk of ids, then removes their files on a pool of threads.
+
+    The asset post_delete handler leaves the files to the pool, rather than removing each file serially.
+
+    Args:
+        asset_uids: A list of asset uids to remove, matched exactly.
+
+    Returns:
+        A tuple of the number of assets removed, and a list of the files which could not be removed.
+    """
+    from .signals.handlers import asset_file_deletes
+
+    asset_uids = list(set(asset_uid for asset_uid in asset_uids if asset_uid))
+    if not asset_uids:
+        return 0, []
 
-    for feature in Feature.objects.filter(feature_uid=feature_uid):
-        if is_database_used:
-            delete_db_feature(json.loads(feature.feature_data), feature.layer.layer_name, database_alias=database_alias)
-        feature.delete()
+    asset_files = []
+    deleted_count = 0
+    asset_file_deletes.deferred = True
+    try:
+        with transaction.atomic(using=Asset.objects.db):
+            for uid_chunk in chunks(asset_uids, 1000):
+                assets = Asset.objects.filter(asset_uid__in=uid_chunk)
+                chunk_files = list(assets.values_list('asset_data', flat=True))
+                assets.delete()
+                deleted_count += len(chunk_files)
+                asset_files += [asset_file for asset_file in chunk_files if asset_file]
+    finally:
+        asset_file_deletes.deferred = False
+
+    pool = ThreadPool(int(getattr(settings, 'NEARSIGHT_ASSET_THREADS', 8)))
+    try:
+        failed_files = [asset_file for asset_file in pool.map(delete_asset_file, asset_files) if asset_file]
+    finally:
+        pool.close()
+        pool.join()
+    if failed_files:
+        logger.warn("Removed {0} assets, but {1} of their files could not be removed.".format(deleted_count,
+                                                                                           len(failed_files)))
+    return deleted_count, failed_files
+
+
+def delete_asset_file(asset_file):
+    """
+    Args:
+        asset_file: The name of an asset file in the asset storage.
+
+    Returns:
+        None if the file was removed (or was already gone), otherwise the name of the file.
+    """
+    try:
+        Asset._meta.get_field('asset_data').storage.delete(asset_file)
+    except (IOError, OSError) as e:
+        logger.error("Failed to remove the file {0}".format(asset_file))
+        logger.error(e)
+        return asset_file
+    return None
+
+
+def delete_db_features(feature_uids, layer, database_alias=None):
+    """
+
+    Args:
+        feature_uids: A list of nearsight_ids to be removed.
+        layer: The name of the database table.
+        database_alias: The django database structure defined in settings.
+
+    Returns:
+        The number of rows removed from the table.
+    """
+    if not is_alnum(layer):
+        return 0
+
+    cur = get_layer_session(database_alias).cursor()
+
+    query = "DELETE FROM {} WHERE {} = ANY(%s);".format(layer, get_nearsight_id_fieldname())
+
+    deleted_count = 0
+    try:
+        with transaction.atomic(using=database_alias):
+            for uid_chunk in chunks(feature_uids, 1000):
+                cur.execute(query, [uid_chunk])
+                deleted_count += cur.rowcount
+    except ProgrammingError:
+        logger.error("Unable to delete {0} features from {1}.".format(len(feature_uids), layer))
+        logger.error("The table most likely does not exist.")
+    finally:
+        cur.close()
+    return deleted_count
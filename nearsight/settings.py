@@ -31,6 +31,20 @@ NEARSIGHT_UPLOAD_PATH = os.getenv("NEARSIGHT_UPLOAD_PATH")
 NEARSIGHT_LAYER_PREFIX = os.getenv("NEARSIGHT_LAYER_PREFIX")
 NEARSIGHT_CATEGORY_NAME = os.getenv('NEARSIGHT_CATEGORY_NAME', 'NearSight')
 NEARSIGHT_GEONODE_RESTRICTIONS = os.getenv('NEARSIGHT_GEONODE_RESTRICTIONS', "NearSight Data")
+NEARSIGHT_FILTER_PARALLEL_THRESHOLD = int(os.getenv('NEARSIGHT_FILTER_PARALLEL_THRESHOLD', 10000))
+NEARSIGHT_FILTER_PROCESSES = os.getenv('NEARSIGHT_FILTER_PROCESSES')
+NEARSIGHT_FILTER_BATCH_SIZE = int(os.getenv('NEARSIGHT_FILTER_BATCH_SIZE', 1000))
+NEARSIGHT_FILTER_SAMPLE_SIZE = int(os.getenv('NEARSIGHT_FILTER_SAMPLE_SIZE', 200))
+NEARSIGHT_ASSET_THREADS = int(os.getenv('NEARSIGHT_ASSET_THREADS', 8))
+NEARSIGHT_LOAD_BATCH_SIZE = int(os.getenv('NEARSIGHT_LOAD_BATCH_SIZE', 10000))
+NEARSIGHT_LOAD_PARALLEL_THRESHOLD = int(os.getenv('NEARSIGHT_LOAD_PARALLEL_THRESHOLD', 50000))
+NEARSIGHT_LOAD_PROCESSES = os.getenv('NEARSIGHT_LOAD_PROCESSES')
+NEARSIGHT_ANALYZE_THRESHOLD = int(os.getenv('NEARSIGHT_ANALYZE_THRESHOLD', 10000))
+# Partitioned tables have no primary key constraint, GeoServer reads their key from gt_pk_metadata (see the README).
+NEARSIGHT_LAYER_PARTITIONING = os.getenv('NEARSIGHT_LAYER_PARTITIONING')
+NEARSIGHT_LAYER_PARTITIONS = int(os.getenv('NEARSIGHT_LAYER_PARTITIONS', 16))
+NEARSIGHT_LAYER_TRANSACTION = os.getenv('NEARSIGHT_LAYER_TRANSACTION', 'False').lower() == 'true'
+NEARSIGHT_OGR2OGR_STDIN = os.getenv('NEARSIGHT_OGR2OGR_STDIN', 'False').lower() == 'true'
 
 
 S3_CREDENTIALS = [
@@ -14,12 +14,26 @@
 
 from __future__ import absolute_import
 
-from django.db.models.signals import post_delete
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
-from ..models import Asset
+from ..models import Asset, Filter, FilterArea, TextFilter
+from ..filters.run_filters import invalidate_filters
+import threading
+
+# Set while purge_assets deletes assets in this thread, it removes their files on a pool of threads afterwards.
+asset_file_deletes = threading.local()
 
 
 @receiver(post_delete, sender=Asset)
 def asset_file_delete(sender, instance, **kwargs):
+    if getattr(asset_file_deletes, 'deferred', False):
+        return
     # Pass false so FileField doesn't save the model.
-    instance.file.delete(False)
+    instance.asset_data.delete(False)
+
+
+@receiver([post_save, post_delete], sender=Filter)
+@receiver([post_save, post_delete], sender=FilterArea)
+@receiver([post_save, post_delete], sender=TextFilter)
+def filter_settings_changed(sender, instance, **kwargs):
+    invalidate_filters()
@@ -81,9 +81,21 @@ def update_tiles(filtered_features, layer_name=''):
 
 
 @shared_task(name="nearsight.tasks.task_filter_features")
-def task_filter_features(filter_name, features, run_once=False, run_time=None):
-    from .models import Filter, Layer
-    from .filters.run_filters import filter_features
+def task_filter_features(filter_name, after_time_added=None, run_once=False, run_time=None):
+    """
+    Args:
+        filter_name: The name of the filter to run.
+        after_time_added: An ISO date string, only features added to the db after this date are filtered.
+        run_once: Run the filter one time without being active.
+        run_time: An ISO date string to store as the time the filter last ran.
+
+    The features are read from the db in batches of NEARSIGHT_FILTER_BATCH_SIZE, and filtered one batch at a time.
+    Feature versions which were already filtered with the current filter settings are not filtered again.
+    If every feature is filtered and the filter supports it, the features are filtered by the database instead.
+    """
+    from .models import Filter, Layer, get_feature_batches
+    from .filters.run_filters import filter_features, prune_filter_decisions, filter_previous_in_db
+    from dateutil.parser import parse
 
     if not check_filters():
         return False
@@ -96,9 +108,18 @@ def task_filter_features(filter_name, features, run_once=False, run_time=None):
         while is_feature_task_locked():
             time.sleep(1)
         try:
-            filtered_features = filter_features(features, filter_name=filter_name, run_once=run_once)
+            if after_time_added:
+                after_time_added = parse(after_time_added)
+            if not (run_once and filter_previous_in_db(filter_name, after_time_added=after_time_added)):
+                prune_filter_decisions(filter_model)
+                batch_size = int(getattr(settings, 'NEARSIGHT_FILTER_BATCH_SIZE', 1000))
+                for features in get_feature_batches(after_time_added=after_time_added, batch_size=batch_size):
+                    filter_features({"type": "FeatureCollection", "features": features},
+                                    filter_name=filter_name,
+                                    run_once=run_once,
+                                    memoize=True)
             for layer in Layer.objects.all():
-                update_tiles(filtered_features=filtered_features, layer_name=layer.layer_name)
+                update_tiles(filtered_features=None, layer_name=layer.layer_name)
             filter_model.filter_previous_time = run_time
         finally:
             release_lock(Filter.get_lock_id(task_name, filter_model.filter_name))
@@ -109,7 +130,7 @@ def task_filter_features(filter_name, features, run_once=False, run_time=None):
 def task_filter_assets(filter_name, after_time_added, run_once=False, run_time=None):
     from .models import Filter, Asset
     from dateutil.parser import parse
-    from .nearsight import is_valid_photo
+    from .nearsight import find_invalid_assets, purge_assets
 
     task_name = "nearsight.tasks.task_filter_assets"
     filter_lock_expire = 60 * 60
@@ -120,14 +141,9 @@ def task_filter_assets(filter_name, after_time_added, run_once=False, run_time=N
         while is_feature_task_locked():
             time.sleep(1)
         try:
-            delete_list = []
-            for asset in assets:
-                if asset.asset_type == 'photos':
-                    if not is_valid_photo(asset.asset_data.path, filter_name=filter_name, run_once=run_once):
-                        logger.info("Attempting to delete {}".format(asset.asset_data.path))
-                        delete_list += [asset.asset_uid]
-            for asset_uid in delete_list:
-                Asset.objects.filter(asset_uid__iexact=asset_uid).delete()
+            delete_list = find_invalid_assets(assets, filter_name=filter_name, run_once=run_once)
+            deleted_count, failed_files = purge_assets(delete_list)
+            logger.info("Removed {0} assets which failed the {1} filter.".format(deleted_count, filter_name))
             filter_model.filter_previous_time = run_time
         finally:
             release_lock(Filter.get_lock_id(task_name, filter_model.filter_name))
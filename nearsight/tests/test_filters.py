@@ -14,19 +14,166 @@
 from __future__ import absolute_import
 
 from django.test import TestCase
-from ..filters.run_filters import check_filters
+from ..filters.run_filters import check_filters, registry, get_filter_version, run_filter_chain, RegisteredFilter
+from ..filters.run_filters import run_memoized_filter_chain, estimate_filter_impact, get_failed_interval
+from ..filters import geospatial_filter, us_phone_number_filter, text_filter
 from ..filters.geospatial_filter import filter_features as filter_spatial_features
-from ..filters.geospatial_filter import get_boundary_features, check_geometry
+from ..filters.geospatial_filter import get_boundary_features, check_geometry, check_feature
 from ..filters.us_phone_number_filter import filter_features as filter_number_features, check_numbers, get_area_codes
 import os
 import json
+import copy
 
 
 class FilterTests(TestCase):
 
     def setUp(self):
+        from ..models import Filter
+
+        # Each test's rows are rolled back, so the Filter models are created for every test.
+        for filter_name in ['geospatial_filter.py', 'us_phone_number_filter.py', 'text_filter.py']:
+            Filter.objects.get_or_create(filter_name=filter_name)
         check_filters()
 
+    def test_filter_registry(self):
+        """
+        Test the filter registry
+        Every filter module should be imported once, and saving a filter should change the filter version.
+        """
+        from ..models import Filter
+
+        modules = registry.discover()
+        self.assertIn('geospatial_filter.py', modules)
+        self.assertIn('us_phone_number_filter.py', modules)
+        self.assertNotIn('run_filters.py', modules)
+        self.assertIs(modules, registry.discover())
+
+        filters = registry.get_filters('geospatial_filter.py')
+        self.assertEqual(len(filters), 1)
+        self.assertIs(filters[0].module, modules.get('geospatial_filter.py'))
+
+        version = get_filter_version()
+        filter_model = Filter.objects.get(filter_name='geospatial_filter.py')
+        filter_model.filter_active = False
+        filter_model.save()
+        self.assertNotEqual(version, get_filter_version())
+        self.assertFalse(registry.get_filters('geospatial_filter.py')[0].model.filter_active)
+
+    def test_run_filter_chain(self):
+        """
+        Test the composed filter chain
+        US features should be rejected by the geospatial filter, before the phone number filter is called.
+        """
+        from ..models import Filter
+
+        geojson_path = os.path.join(os.path.join(os.path.dirname(__file__), 'boundary_polygons'),
+                                    'us_boundaries.geojson')
+        with open(geojson_path) as geojson_file:
+            boundary_features = get_boundary_features(geojson_file.read(), 0.1)
+        spatial_filter = RegisteredFilter(Filter.objects.get(filter_name='geospatial_filter.py'), geospatial_filter)
+        spatial_filter.predicate = geospatial_filter.get_predicate(spatial_filter.model,
+                                                                   boundary_features=boundary_features,
+                                                                   filter_inclusion=False)
+        number_filter = RegisteredFilter(Filter.objects.get(filter_name='us_phone_number_filter.py'),
+                                         us_phone_number_filter)
+        number_filter.predicate = us_phone_number_filter.get_predicate(number_filter.model, filter_inclusion=False)
+
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'passed_test_features.geojson')) as testfile:
+            features = json.load(testfile)
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'failed_test_features.geojson')) as testfile:
+            features2 = json.load(testfile)
+        features['features'] += features2['features']
+        parallel_features = copy.deepcopy(features)
+
+        # The spatial filter is cheaper, so it runs first even though it is listed last.
+        spatial_filter.cost = 0.001
+        number_filter.cost = 0.002
+        filtered = run_filter_chain(features, [number_filter, spatial_filter])
+        self.assertEqual(len(filtered.get('passed').get('features')), 3)
+        self.assertEqual(len(filtered.get('failed').get('features')), 7)
+        rejected_by = [feature.get('rejected_by') for feature in filtered.get('failed').get('features')]
+        self.assertEqual(rejected_by.count('geospatial_filter.py'), 5)
+        self.assertEqual(rejected_by.count('us_phone_number_filter.py'), 2)
+
+        # The costs measured by the first run could reorder the chain.
+        spatial_filter.cost = 0.001
+        number_filter.cost = 0.002
+        parallel_filtered = run_filter_chain(parallel_features, [number_filter, spatial_filter], parallel=True)
+        self.assertEqual(filtered.get('passed'), parallel_filtered.get('passed'))
+        self.assertEqual(filtered.get('failed'), parallel_filtered.get('failed'))
+
+    def test_run_memoized_filter_chain(self):
+        """
+        Test the filter decisions
+        A feature version should only be filtered again if it is new or the filter settings changed.
+        """
+        from ..models import Filter, FilterDecision
+
+        filtered_features = []
+
+        def predicate(feature):
+            filtered_features.append(feature)
+            return feature.get('properties').get('number') != '443-908-8888'
+
+        number_filter = RegisteredFilter(Filter.objects.get(filter_name='us_phone_number_filter.py'),
+                                         us_phone_number_filter)
+        number_filter.predicate = predicate
+        features = {"type": "FeatureCollection",
+                    "features": [{"type": "Feature", "properties": {"nearsight_id": "1", "version": 1,
+                                                                    "number": '4439088888'}},
+                                 {"type": "Feature", "properties": {"nearsight_id": "2", "version": 1,
+                                                                    "number": '443-908-8888'}}]}
+
+        filtered = run_memoized_filter_chain(copy.deepcopy(features), [number_filter])
+        self.assertEqual(len(filtered.get('passed').get('features')), 1)
+        self.assertEqual(len(filtered.get('failed').get('features')), 1)
+        self.assertEqual(len(filtered_features), 2)
+        self.assertEqual(FilterDecision.objects.count(), 2)
+
+        filtered = run_memoized_filter_chain(copy.deepcopy(features), [number_filter])
+        self.assertEqual(len(filtered.get('passed').get('features')), 1)
+        self.assertEqual(filtered.get('failed').get('features')[0].get('rejected_by'), 'us_phone_number_filter.py')
+        self.assertEqual(len(filtered_features), 2)
+
+        features['features'][0]['properties']['version'] = 2
+        run_memoized_filter_chain(copy.deepcopy(features), [number_filter])
+        self.assertEqual(len(filtered_features), 3)
+
+        number_filter.config_hash = 'changed'
+        run_memoized_filter_chain(copy.deepcopy(features), [number_filter])
+        self.assertEqual(len(filtered_features), 5)
+
+    def test_estimate_filter_impact(self):
+        """
+        Test the filter estimate
+        When every feature is sampled the estimate should be exact, and no features should be deleted.
+        """
+        from ..models import Filter, Layer, Feature
+
+        example_layer = Layer.objects.create(layer_name="example", layer_uid="unique")
+        for index, number in enumerate(['443-908-8888', '4439088888', '888-908-8888', '(443)908-8888']):
+            feature = {"type": "Feature", "properties": {"nearsight_id": str(index), "version": 1, "number": number}}
+            Feature.objects.create(layer=example_layer,
+                                   feature_uid=str(index),
+                                   feature_version=1,
+                                   feature_data=json.dumps(feature))
+        filter_model = Filter.objects.get(filter_name='us_phone_number_filter.py')
+        filter_model.filter_inclusion = False
+
+        estimate = estimate_filter_impact(filter_model, sample_size=10)
+        self.assertEqual(estimate.get('feature_count'), 4)
+        self.assertEqual(estimate.get('failed_estimate'), 2)
+        self.assertEqual(estimate.get('passed_estimate'), 2)
+        self.assertEqual(estimate.get('failed_low'), 2)
+        self.assertEqual(estimate.get('failed_high'), 2)
+        self.assertEqual(estimate.get('layers')[0].get('layer_name'), 'example')
+        self.assertEqual(Feature.objects.count(), 4)
+
+        # A sample with no failed features still allows for some failures in the rest of the layer.
+        failed_low, failed_high = get_failed_interval(0, 200, 10000)
+        self.assertAlmostEqual(failed_low, 0.0)
+        self.assertGreater(failed_high, 0.0)
+
     def test_get_boundary_features(self):
         """
         Test boundary feature creation
@@ -55,6 +202,12 @@ class FilterTests(TestCase):
         us_out = [-105.1171875, 4.565473550710278]
         self.assertFalse(check_geometry(us_out, boundary_features))
 
+        # Lines are checked at a point on the line, the same as when filtering in the database.
+        us_line = {"type": "Feature", "properties": {},
+                   "geometry": {"type": "LineString", "coordinates": [[-83.0, 38.0], [-82.0, 38.5]]}}
+        self.assertFalse(check_feature(us_line, [boundary_features], filter_inclusion=False))
+        self.assertTrue(check_feature(us_line, [boundary_features], filter_inclusion=True))
+
     def test_full_geometry_filter_features(self):
         """
         Test geometry filter on geojson
@@ -221,3 +374,43 @@ class FilterTests(TestCase):
         filtered_features = filter_number_features(my_features, filter_inclusion=False)
         self.assertEqual(len(filtered_features.get('passed').get('features')), 4)
         self.assertEqual(len(filtered_features.get('failed').get('features')), 4)
+
+    def test_text_filter(self):
+        """
+        Test the text filter
+        Features with a keyword (in any case) or a pattern in any property value should be filtered out.
+        """
+        from ..models import Filter, TextFilter
+
+        filter_model = Filter.objects.get(filter_name='text_filter.py')
+        TextFilter.objects.create(filter=filter_model,
+                                  text_filter_keywords="restricted\nsecret base",
+                                  text_filter_patterns="\\bAB-\\d{3}\\b")
+        TextFilter.objects.create(filter=filter_model,
+                                  text_filter_enabled=False,
+                                  text_filter_keywords="ignored")
+        my_features = {
+            "type": "FeatureCollection",
+            "features": [
+                {"type": "Feature", "properties": {"name": "The Secret Base"}},
+                {"type": "Feature", "properties": {"tags": [{"code": "AB-123"}]}},
+                {"type": "Feature", "properties": {"name": "ignored", "code": "AB-1234"}},
+                {"type": "Feature", "properties": {"notes": "RESTRICTED area", "count": 3}}
+            ]
+        }
+
+        results = text_filter.filter_features(my_features)
+        self.assertEqual(len(results.get('passed').get('features')), 1)
+        self.assertEqual(len(results.get('failed').get('features')), 3)
+
+        matcher = text_filter.TextMatcher(keywords=['he', 'she', 'his', 'hers'])
+        self.assertTrue(matcher.search(u'ushers'))
+        self.assertFalse(matcher.search(u'h e'))
+        self.assertTrue(text_filter.TextMatcher().is_empty())
+
+        # A backreference still refers to its own pattern's group when other patterns are configured.
+        matcher = text_filter.TextMatcher(patterns=['\\bAB-\\d{3}\\b', '(\\w)\\1{3}', '(?P<word>x+)y(?P=word)'])
+        self.assertEqual(len(matcher.patterns), 3)
+        self.assertTrue(matcher.search(u'zzzz'))
+        self.assertTrue(matcher.search(u'xxyxx'))
+        self.assertFalse(matcher.search(u'zzz'))
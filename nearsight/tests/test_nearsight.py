@@ -18,7 +18,7 @@ from ..nearsight import *
 import inspect
 from ..models import *
 import copy
-from django.db import IntegrityError, transaction, connections
+from django.db import IntegrityError, DatabaseError, transaction, connections
 
 
 class NearSightTests(TestCase):
@@ -105,36 +105,20 @@ class NearSightTests(TestCase):
                                           feature_data=json.dumps(second_feature))
         self.assertIsNotNone(feature2)
 
-    def test_sort_features(self):
-        """Ensures that features are properly sorted (in ascending order)."""
-        unsorted_features = [{'properties': {'id': 'cdec0e00-f511-44bf-a94e-165f930ce7d4', 'version': 2}},
-                             {'properties': {'id': 'cdec0e00-f511-44bf-a94e-165f930ce7d5', 'version': 2}},
-                             {'properties': {'id': 'cdec0e00-f511-44bf-a94e-165f930ce7d4', 'version': 1}},
-                             {'properties': {'id': 'cdec0e00-f511-44bf-a94e-165f930ce7d5', 'version': 1}}]
-        expected_sorted_by_version_features = [
-            {'properties': {'id': 'cdec0e00-f511-44bf-a94e-165f930ce7d4', 'version': 1}},
-            {'properties': {'id': 'cdec0e00-f511-44bf-a94e-165f930ce7d5', 'version': 1}},
-            {'properties': {'id': 'cdec0e00-f511-44bf-a94e-165f930ce7d4', 'version': 2}},
-            {'properties': {'id': 'cdec0e00-f511-44bf-a94e-165f930ce7d5', 'version': 2}}]
-        expected_sorted_by_id_features = [{'properties': {'id': 'cdec0e00-f511-44bf-a94e-165f930ce7d4', 'version': 2}},
-                                          {'properties': {'id': 'cdec0e00-f511-44bf-a94e-165f930ce7d4', 'version': 1}},
-                                          {'properties': {'id': 'cdec0e00-f511-44bf-a94e-165f930ce7d5', 'version': 2}},
-                                          {'properties': {'id': 'cdec0e00-f511-44bf-a94e-165f930ce7d5', 'version': 1}}]
-        expected_sorted_by_version_then_id = [
-            {'properties': {'id': 'cdec0e00-f511-44bf-a94e-165f930ce7d4', 'version': 1}},
-            {'properties': {'id': 'cdec0e00-f511-44bf-a94e-165f930ce7d4', 'version': 2}},
-            {'properties': {'id': 'cdec0e00-f511-44bf-a94e-165f930ce7d5', 'version': 1}},
-            {'properties': {'id': 'cdec0e00-f511-44bf-a94e-165f930ce7d5', 'version': 2}}]
-
-        sorted_by_version_features = sort_features(unsorted_features, properties_key='version')
-        self.assertEqual(sorted_by_version_features, expected_sorted_by_version_features)
-
-        sorted_by_id_features = sort_features(unsorted_features, properties_key='id')
-        self.assertEqual(expected_sorted_by_id_features, sorted_by_id_features)
-
-        sorted_by_version_then_id = sort_features(sort_features(unsorted_features, properties_key='version')
-                                                  , properties_key='id')
-        self.assertEqual(sorted_by_version_then_id, expected_sorted_by_version_then_id)
+    def test_get_feature_batches(self):
+        """Ensures that every feature is read once in pages, even if features are deleted between pages."""
+        example_layer = Layer.objects.create(layer_name="example", layer_uid="unique")
+        for index in range(5):
+            feature = {"type": "Feature", "properties": {"nearsight_id": str(index), "version": 1}}
+            Feature.objects.create(layer=example_layer,
+                                   feature_uid=feature.get('properties').get('nearsight_id'),
+                                   feature_version=1,
+                                   feature_data=json.dumps(feature))
+        batches = []
+        for features in get_feature_batches(batch_size=2):
+            batches += [[feature.get('properties').get('nearsight_id') for feature in features]]
+            Feature.objects.filter(feature_uid=batches[-1][0]).delete()
+        self.assertEqual([['0', '1'], ['2', '3'], ['4']], batches)
 
     def test_get_duplicate_features(self):
         """Ensures that feature duplicates can be found and that they are all accounted for."""
@@ -144,17 +128,30 @@ class NearSightTests(TestCase):
                              {'properties': {'id': 'cdec0e00-f511-44bf-a94e-165f930ce7d5', 'version': 1}},
                              {'properties': {'id': 'cdec0e00-f511-44bf-a94e-165f931ee7d5', 'version': 2}}]
 
-        expected_unique_features = [{'properties': {'id': 'cdec0e00-f511-44bf-a94e-165f930ce7d4', 'version': 1}},
-                                    {'properties': {'id': 'cdec0e00-f511-44bf-a94e-165f930ce7d5', 'version': 1}},
+        expected_unique_features = [{'properties': {'id': 'cdec0e00-f511-44bf-a94e-165f930ce7d4', 'version': 2}},
+                                    {'properties': {'id': 'cdec0e00-f511-44bf-a94e-165f930ce7d5', 'version': 2}},
                                     {'properties': {'id': 'cdec0e00-f511-44bf-a94e-165f931ee7d5', 'version': 2}}]
 
-        expected_non_unique_features = [{'properties': {'id': 'cdec0e00-f511-44bf-a94e-165f930ce7d4', 'version': 2}},
-                                        {'properties': {'id': 'cdec0e00-f511-44bf-a94e-165f930ce7d5', 'version': 2}}]
-
-        unique_features, non_unique_features = get_duplicate_features(features=unsorted_features, properties_id='id')
+        unique_features, superseded_count = get_duplicate_features(features=unsorted_features, properties_id='id')
 
         self.assertEqual(expected_unique_features, unique_features)
-        self.assertEqual(expected_non_unique_features, non_unique_features)
+        self.assertEqual(2, superseded_count)
+
+    def test_get_layer_session(self):
+        """Ensures helpers share the open layer session for their database."""
+        self.assertIsNot(get_layer_session(), get_layer_session())
+        with LayerSession() as session:
+            self.assertIs(session, get_layer_session())
+            with LayerSession() as inner_session:
+                self.assertIs(inner_session, get_layer_session())
+            self.assertIs(session, get_layer_session())
+        self.assertIsNot(session, get_layer_session())
+
+    def test_get_shard(self):
+        """Ensures features are spread over the shards and the same id is always in the same shard."""
+        shards = [get_shard(str(feature_id), 4) for feature_id in range(100)]
+        self.assertEqual(set(range(4)), set(shards))
+        self.assertEqual(get_shard(u'caf\xe9', 4), get_shard(u'caf\xe9', 4))
 
     def test_features_to_file(self):
         """Ensures that features are written into a file and that the file is in a format which can be read back."""
@@ -188,6 +185,13 @@ class NearSightTests(TestCase):
         self.assertEqual(expected_result, imported_geojson)
         self.assertFalse(os.path.isfile(test_path))
 
+        # Without a path each call should write to its own temporary file.
+        first_path = features_to_file(test_features)
+        second_path = features_to_file(test_features)
+        self.assertNotEqual(first_path, second_path)
+        os.remove(first_path)
+        os.remove(second_path)
+
     def test_convert_to_epoch_time(self):
         """Maintains the integrity of the time conversion function."""
         date = "2016-01-28 14:36:59 UTC"
@@ -479,6 +483,13 @@ class NearSightTests(TestCase):
         coords2 = get_gps_coords(properties2)
         self.assertEqual([38.889775, -77.456342], coords2)
 
+    def test_read_photo_gps(self):
+        import os
+
+        script_path = os.path.dirname(os.path.abspath(__file__))
+        self.assertIsNone(read_photo_gps(os.path.join(script_path, 'good_photo.jpg')))
+        self.assertEqual([38.889775, -77.456342], read_photo_gps(os.path.join(script_path, 'bad_photo.jpg')))
+
 
 class NearSightDBTests(TransactionTestCase):
     """Test cases for model functions to prevent locking issues due to transactions."""
@@ -506,6 +517,27 @@ class NearSightDBTests(TransactionTestCase):
 
         self.assertTrue(table_exists(table=table_name))
 
+        # Tables which exist are remembered until they are forgotten, or for EXISTING_TABLE_SECONDS.
+        with transaction.atomic():
+            cur = connection.cursor()
+            cur.execute("DROP TABLE {};".format(table_name))
+            cur.close()
+        self.assertTrue(table_exists(table=table_name))
+        forget_table_exists(table=table_name)
+        self.assertFalse(table_exists(table=table_name))
+
+        with transaction.atomic():
+            cur = connection.cursor()
+            cur.execute(query)
+            cur.close()
+        self.assertTrue(table_exists(table=table_name))
+        with transaction.atomic():
+            cur = connection.cursor()
+            cur.execute("DROP TABLE {};".format(table_name))
+            cur.close()
+        existing_tables[(None, table_name)] -= EXISTING_TABLE_SECONDS
+        self.assertFalse(table_exists(table=table_name))
+
     def test_upload_to_db(self):
         """Ensures data is properly updated to a presumed remote database or separate table."""
         table_name = "test_upload_to_db"
@@ -633,6 +665,120 @@ class NearSightDBTests(TransactionTestCase):
         self.assertEqual("Dinagat Islands", imported_name)
         os.remove(geojson_file)
 
+    def test_copy_features_to_db(self):
+        """Ensures features are copied into the matching columns of an existing table."""
+        table_name = 'test_copy_features_to_db'
+
+        with transaction.atomic():
+            cur = connection.cursor()
+            cur.execute("CREATE TABLE {}(ogc_fid serial, nearsight_id varchar, version integer, "
+                        "wkb_geometry geometry(Point, 4326));".format(table_name))
+            cur.close()
+
+        test_features = [{"type": "Feature",
+                          "geometry": {"type": "Point", "coordinates": [125.6, 10.1]},
+                          "properties": {"nearsight_id": "123", "version": 2, "unknown": "dropped"}},
+                         {"type": "Feature",
+                          "geometry": None,
+                          "properties": {"nearsight_id": u"caf\xe9", "version": ""}}]
+
+        self.assertTrue(copy_features_to_db(test_features, table_name))
+
+        cur = connection.cursor()
+        cur.execute("SELECT nearsight_id, version, ST_AsText(wkb_geometry) FROM {} ORDER BY ogc_fid;".format(
+            table_name))
+        self.assertEqual([('123', 2, 'POINT(125.6 10.1)'), (u'caf\xe9', None, None)], cur.fetchall())
+        cur.close()
+
+    def test_get_db_features(self):
+        """Ensures only the requested features are looked up."""
+        table_name = 'test_get_db_features'
+
+        with transaction.atomic():
+            cur = connection.cursor()
+            cur.execute("CREATE TABLE {}(ogc_fid serial, nearsight_id varchar, version integer);".format(table_name))
+            cur.execute("INSERT INTO {} (nearsight_id, version) values('1', 1), ('2', 3), ('3', 1);".format(
+                table_name))
+            cur.close()
+
+        db_features = get_db_features(table_name, ['2', '4'])
+        self.assertEqual(['2'], db_features.keys())
+        self.assertEqual(3, db_features.get('2').get('version'))
+        self.assertEqual(2, db_features.get('2').get('ogc_fid'))
+        self.assertIsNone(get_db_features('test_missing_table', ['1']))
+
+    def test_stage_features_to_db(self):
+        """Ensures staged features are merged by their latest version and older versions are rejected."""
+        table_name = 'test_stage_features_to_db'
+
+        with transaction.atomic():
+            cur = connection.cursor()
+            cur.execute("CREATE TABLE {}(ogc_fid serial primary key, nearsight_id varchar unique, version integer, "
+                        "meta varchar);".format(table_name))
+            cur.execute("INSERT INTO {} (nearsight_id, version, meta) values('1', 2, 'GOOD');".format(table_name))
+            cur.close()
+
+        test_features = [{"type": "Feature", "properties": {"nearsight_id": "1", "version": 1, "meta": "BAD"}},
+                         {"type": "Feature", "properties": {"nearsight_id": "2", "version": 3, "meta": "GOOD"}},
+                         {"type": "Feature", "properties": {"nearsight_id": "2", "version": 1, "meta": "BAD"}}]
+
+        self.assertEqual([], stage_features_to_db(test_features, table_name))
+
+        cur = connection.cursor()
+        cur.execute("SELECT nearsight_id, version, meta FROM {} ORDER BY nearsight_id;".format(table_name))
+        self.assertEqual([('1', 2, 'GOOD'), ('2', 3, 'GOOD')], cur.fetchall())
+        cur.execute("SELECT count(*) FROM pg_class WHERE relname LIKE %s;", ['{}_staging_%'.format(table_name)])
+        self.assertEqual(0, cur.fetchone()[0])
+        cur.close()
+
+    def test_upsert_features_to_db(self):
+        """Ensures new features are inserted, newer versions update their row and older versions are rejected."""
+        table_name = 'test_upsert_features_to_db'
+
+        with transaction.atomic():
+            cur = connection.cursor()
+            cur.execute("CREATE TABLE {}(ogc_fid serial primary key, nearsight_id varchar unique, version integer, "
+                        "meta varchar);".format(table_name))
+            cur.execute("INSERT INTO {} (nearsight_id, version, meta) values('1', 2, 'GOOD');".format(table_name))
+            cur.execute("INSERT INTO {} (nearsight_id, version, meta) values('2', 1, 'OLD');".format(table_name))
+            cur.close()
+
+        test_features = [{"type": "Feature", "properties": {"nearsight_id": "1", "version": 1, "meta": "BAD"}},
+                         {"type": "Feature", "properties": {"nearsight_id": "2", "version": 2, "meta": "GOOD"}},
+                         {"type": "Feature", "properties": {"nearsight_id": "3", "version": 1, "meta": "GOOD"}}]
+
+        self.assertTrue(upsert_features_to_db(test_features, table_name))
+
+        cur = connection.cursor()
+        cur.execute("SELECT nearsight_id, version, meta FROM {} ORDER BY nearsight_id;".format(table_name))
+        self.assertEqual([('1', 2, 'GOOD'), ('2', 2, 'GOOD'), ('3', 1, 'GOOD')], cur.fetchall())
+        cur.close()
+
+    def test_load_in_pool(self):
+        """Ensures the shards copied by a pool of processes, or of threads, are merged into the table."""
+        table_name = 'test_load_in_pool'
+
+        with transaction.atomic():
+            cur = connection.cursor()
+            cur.execute("CREATE TABLE {}(ogc_fid serial primary key, nearsight_id varchar unique, version integer, "
+                        "meta varchar);".format(table_name))
+            cur.close()
+
+        for version, threads in [(1, False), (2, True)]:
+            test_features = [{"type": "Feature", "properties": {"nearsight_id": str(feature_id), "version": version,
+                                                                "meta": str(version)}}
+                             for feature_id in range(6)]
+            staging_table = create_staging_table(table=table_name)
+            try:
+                self.assertTrue(load_in_pool(test_features, table_name, staging_table, 2, threads=threads))
+            finally:
+                drop_staging_table(staging_table=staging_table)
+
+            cur = connection.cursor()
+            cur.execute("SELECT nearsight_id, version, meta FROM {} ORDER BY nearsight_id;".format(table_name))
+            self.assertEqual([(str(feature_id), version, str(version)) for feature_id in range(6)], cur.fetchall())
+            cur.close()
+
     def test_add_unique_constraint(self):
         """Ensures logic behind adding unique constraint is consistent."""
 
@@ -670,6 +816,125 @@ class NearSightDBTests(TransactionTestCase):
 
         self.assertFalse(added_duplicate_value)
 
+    def test_add_layer_indexes(self):
+        """Ensures the geometry, version and update time columns are indexed."""
+        table_name = 'test_add_layer_indexes'
+
+        with transaction.atomic():
+            cur = connection.cursor()
+            cur.execute("CREATE TABLE {}(ogc_fid serial, version integer, updated_at varchar, "
+                        "wkb_geometry geometry(Point, 4326));".format(table_name))
+            cur.close()
+
+        add_layer_indexes(table=table_name)
+
+        cur = connection.cursor()
+        cur.execute("SELECT indexname FROM pg_indexes WHERE tablename = %s ORDER BY indexname;", [table_name])
+        self.assertEqual([('test_add_layer_indexes_updated_at_idx',),
+                          ('test_add_layer_indexes_version_idx',),
+                          ('test_add_layer_indexes_wkb_geometry_gist',)], cur.fetchall())
+        cur.close()
+
+    def test_partition_layer_table(self):
+        """Ensures a new table is partitioned by month and old months can be dropped."""
+        from datetime import datetime
+        table_name = 'test_partition_layer_table'
+
+        with transaction.atomic():
+            cur = connection.cursor()
+            cur.execute("CREATE TABLE {}(ogc_fid serial, nearsight_id varchar, version integer, "
+                        "updated_at varchar);".format(table_name))
+            cur.execute("INSERT INTO {} (nearsight_id, version, updated_at) "
+                        "values('1', 1, '2017-06-28T12:43:00Z');".format(table_name))
+            cur.close()
+        features = [{"type": "Feature", "properties": {"nearsight_id": "2", "version": 1,
+                                                       "updated_at": "2017-07-02T10:00:00Z"}}]
+
+        self.assertTrue(partition_layer_table(table=table_name, partitioning='month', features=features))
+        self.assertEqual('range', get_layer_session().get_partitioning(table_name))
+        self.assertTrue(copy_features_to_db(features, table_name))
+
+        cur = connection.cursor()
+        cur.execute("SELECT nearsight_id FROM {}_p201706;".format(table_name))
+        self.assertEqual([('1',)], cur.fetchall())
+        cur.execute("SELECT nearsight_id FROM {}_p201707;".format(table_name))
+        self.assertEqual([('2',)], cur.fetchall())
+        cur.execute("SELECT pk_column, pk_policy FROM {} WHERE table_name = %s;".format(PK_METADATA_TABLE),
+                    [table_name])
+        self.assertEqual([('ogc_fid', 'sequence')], cur.fetchall())
+        cur.close()
+
+        drop_layer_partitions(table=table_name, before=datetime(2017, 7, 1))
+        self.assertFalse(table_exists(table='{}_p201706'.format(table_name)))
+        self.assertEqual(['2'], get_db_features(table_name, ['1', '2']).keys())
+
+    def test_set_up_layer_table(self):
+        """Ensures a table which can't be partitioned by month still gets a unique nearsight_id."""
+        table_name = 'test_set_up_layer_table'
+
+        with transaction.atomic():
+            cur = connection.cursor()
+            cur.execute("CREATE TABLE {}(ogc_fid serial, nearsight_id varchar, version integer);".format(table_name))
+            cur.close()
+
+        self.assertFalse(set_up_layer_table(table=table_name, key_name='nearsight_id', partitioning='month'))
+        self.assertIsNone(get_layer_session().get_partitioning(table_name))
+        cur = connection.cursor()
+        cur.execute("SELECT count(*) FROM pg_constraint WHERE conrelid = to_regclass(%s) AND contype = 'u';",
+                    [table_name])
+        self.assertEqual(1, cur.fetchone()[0])
+        cur.close()
+
+    def test_filter_db_features(self):
+        """Ensures the geospatial filter removes the same layer rows and Feature models as check_feature would."""
+        from ..filters import geospatial_filter
+        table_name = 'test_filter_db_features'
+
+        filter_model, created = Filter.objects.get_or_create(filter_name='geospatial_filter.py')
+        area = {"type": "Feature", "properties": {},
+                "geometry": {"type": "Polygon", "coordinates": [[[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]]]}}
+        FilterArea.objects.create(filter=filter_model, filter_area_name='area', filter_area_buffer=0,
+                                  filter_area_data=json.dumps(area))
+        layer = Layer.objects.create(layer_name=table_name, layer_uid="unique")
+        # The line crosses the area, but like the check_feature it is checked at a point outside of it.
+        geometries = {'in_point': {"type": "Point", "coordinates": [5, 5]},
+                      'out_point': {"type": "Point", "coordinates": [20, 20]},
+                      'in_line': {"type": "LineString", "coordinates": [[1, 1], [2, 2], [3, 3]]},
+                      'out_line': {"type": "LineString", "coordinates": [[9, 5], [12, 5], [40, 5]]}}
+        features = [{"type": "Feature", "geometry": geometry, "properties": {"nearsight_id": feature_id}}
+                    for feature_id, geometry in geometries.items()]
+        filter_list = [geospatial_filter.get_boundary_features(json.dumps(area), 0)]
+
+        for filter_inclusion in [False, True]:
+            with transaction.atomic():
+                cur = connection.cursor()
+                cur.execute("DROP TABLE IF EXISTS {};".format(table_name))
+                cur.execute("CREATE TABLE {}(ogc_fid serial primary key, nearsight_id varchar, "
+                            "wkb_geometry geometry(Geometry, 4326));".format(table_name))
+                for feature in features:
+                    cur.execute("INSERT INTO {} (nearsight_id, wkb_geometry) "
+                                "VALUES (%s, ST_SetSRID(ST_GeomFromGeoJSON(%s), 4326));".format(table_name),
+                                [feature['properties']['nearsight_id'], json.dumps(feature['geometry'])])
+                cur.close()
+            Feature.objects.filter(layer=layer).delete()
+            for feature in features:
+                Feature.objects.create(layer=layer, feature_uid=feature['properties']['nearsight_id'],
+                                       feature_version=1, feature_data=json.dumps(feature))
+            expected_ids = sorted(feature['properties']['nearsight_id'] for feature in features
+                                  if geospatial_filter.check_feature(feature, filter_list, filter_inclusion))
+            self.assertEqual(['in_line', 'in_point'] if filter_inclusion else ['out_line', 'out_point'],
+                             expected_ids)
+
+            filter_model.filter_inclusion = filter_inclusion
+            self.assertEqual(2, geospatial_filter.filter_db_features(filter_model))
+
+            cur = connection.cursor()
+            cur.execute("SELECT nearsight_id FROM {} ORDER BY nearsight_id;".format(table_name))
+            self.assertEqual(expected_ids, [row[0] for row in cur.fetchall()])
+            cur.close()
+            self.assertEqual(expected_ids,
+                             sorted(Feature.objects.filter(layer=layer).values_list('feature_uid', flat=True)))
+
     def test_update_db_feature(self):
         """Ensures logic behind updating a feature is consistent."""
         table_name = 'test_update_db_feature'
@@ -742,6 +1007,77 @@ class NearSightDBTests(TransactionTestCase):
         cur.close()
         connection.close()
 
+    def test_delete_features(self):
+        """Ensures that features are removed from the layer table and the Feature model together."""
+        table_name = 'test_delete_features'
+
+        with transaction.atomic():
+            cur = connection.cursor()
+            cur.execute("CREATE TABLE {}(nearsight_id varchar);".format(table_name))
+            cur.execute("INSERT INTO {} values('1'), ('2'), ('3');".format(table_name))
+            cur.close()
+
+        example_layer = Layer.objects.create(layer_name=table_name, layer_uid="unique")
+        for feature_uid in ['1', '2', '3']:
+            feature = {"type": "Feature", "properties": {"nearsight_id": feature_uid, "version": 1}}
+            Feature.objects.create(layer=example_layer,
+                                   feature_uid=feature_uid,
+                                   feature_version=1,
+                                   feature_data=json.dumps(feature))
+
+        self.assertEqual(2, delete_features(['1', '2']))
+
+        self.assertEqual(['3'], [feature.feature_uid for feature in Feature.objects.all()])
+        cur = connection.cursor()
+        cur.execute("SELECT nearsight_id FROM {};".format(table_name))
+        self.assertEqual([('3',)], cur.fetchall())
+        cur.close()
+
+    def test_purge_assets(self):
+        """Ensures that only the exact asset uids are removed."""
+        for asset_uid in ['asset1', 'asset2', 'ASSET1']:
+            Asset.objects.create(asset_uid=asset_uid, asset_type='photos')
+
+        self.assertEqual((1, []), purge_assets(['asset1', 'missing']))
+
+        self.assertEqual(['ASSET1', 'asset2'], sorted(Asset.objects.values_list('asset_uid', flat=True)))
+
+    def test_layer_transaction(self):
+        """Ensures features in a layer transaction are committed together, and a bad feature is skipped."""
+        example_layer = Layer.objects.create(layer_name="example", layer_uid="unique")
+        feature = {"type": "Feature", "properties": {"nearsight_id": "1", "version": 1}}
+
+        with self.settings(NEARSIGHT_LAYER_TRANSACTION=False):
+            with layer_transaction() as in_transaction:
+                self.assertFalse(in_transaction)
+            # Outside of a layer transaction a feature which can't be written is still an error.
+            with self.assertRaises(DatabaseError):
+                write_feature("2" * 101, 1, example_layer, feature)
+
+        with self.settings(NEARSIGHT_LAYER_TRANSACTION=True):
+            with layer_transaction() as in_transaction:
+                self.assertTrue(in_transaction)
+                self.assertIsNotNone(write_feature("1", 1, example_layer, feature))
+                # The id is longer than the column, so the database rejects the row.
+                self.assertIsNone(write_feature("2" * 101, 1, example_layer, feature, skip_errors=True))
+                self.assertIsNotNone(write_feature("3", 1, example_layer, feature))
+            self.assertEqual(["1", "3"], sorted(Feature.objects.values_list('feature_uid', flat=True)))
+
+            with layer_transaction() as in_transaction:
+                write_feature("4", 1, example_layer, feature)
+                rollback_layer_transaction()
+            self.assertFalse(Feature.objects.filter(feature_uid="4").exists())
+
+            # ogr2ogr creates a new table outside of the transaction, so it is dropped when the load is rolled back.
+            table_name = 'test_layer_transaction'
+            features = [{"type": "Feature", "geometry": {"type": "Point", "coordinates": [-77.0, 38.9]},
+                         "properties": {"nearsight_id": "5", "version": 1}}]
+            with layer_transaction(table=table_name):
+                self.assertTrue(upload_to_db(features, table_name, {}))
+                self.assertTrue(table_exists(table=table_name))
+                rollback_layer_transaction()
+            self.assertFalse(table_exists(table=table_name))
+
     def test_s3_credentials_admin(self):
         """Ensure the expected structure of the s3 credentials is maintained."""
         s3_cred = S3Credential.objects.create(s3_key='key',